@@ -213,6 +213,13 @@ def batch_close_views():
             page_view.save()
 
 
+def rollup_analytics():
+    """Work out the page view end times and parsed user agents the statistics page is built from"""
+    batch_close_views()
+    PageView.calc_durs()
+    UserCookie.calc_uas()
+
+
 def statistics(request):
     batch_close_views()
 
@@ -243,12 +250,12 @@ def statistics(request):
     for visitor in UserCookie.objects.all():
         views_per_visitor.append(PageView.objects.filter(session__user=visitor).count())
 
-    PageView.calc_durs()
     session_durations = []
     for session in Session.objects.all():
         if session.duration is not None:
             session_durations.append(session.duration.seconds / 60)
 
+    # Users since the last rollup_analytics still need their user agents parsed
     UserCookie.calc_uas()
     browser_stats = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(int)))))
     os_stats = defaultdict(
@@ -1,14 +1,36 @@
 from django.contrib import admin
-from .models import Task
+from .models import PeriodicJob, Task
+from .utils import rerun_task
 
 
 class TaskAdmin(admin.ModelAdmin):
-    list_display = ('job', 'args', 'kwargs', 'completed_bool')
+    list_display = ('job', 'queue', 'priority', 'args', 'kwargs', 'attempts', 'completed_bool', 'dead_bool')
+    list_filter = ('queue', ('dead', admin.EmptyFieldListFilter))
+    readonly_fields = ('history',)
+    actions = ['rerun']
 
     @admin.display(description='Completed')
     def completed_bool(self, obj):
         return obj.completed is not None
 
+    @admin.display(description='Dead', boolean=True)
+    def dead_bool(self, obj):
+        return obj.dead is not None
+
+    @admin.action(description='Re-run selected tasks')
+    def rerun(self, request, queryset):
+        # Tasks that are waiting or running will run anyway
+        tasks = list(queryset.exclude(completed=None))
+        for task in tasks:
+            rerun_task(task)
+        self.message_user(request, f'Queued {len(tasks)} completed or dead tasks to run again')
+
+
+class PeriodicJobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'schedule', 'last_run', 'next_run')
+    readonly_fields = ('name', 'schedule', 'last_run')
+
 
 # Register your models here.
 admin.site.register(Task, TaskAdmin)
+admin.site.register(PeriodicJob, PeriodicJobAdmin)
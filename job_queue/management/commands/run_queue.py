@@ -1,35 +1,43 @@
-from django.core.management.base import BaseCommand
-from django.db.models import Q
-from django.utils import timezone
-import time
-from functools import reduce
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 
-from job_queue.models import Task
-from job_queue.utils import run_regular_tasks
+from job_queue.worker import WorkerPool, parse_queues
 
 class Command(BaseCommand):
-    def handle(self, *args, **kwargs):
-        while True:
-            print("checking for queued jobs")
-            task = Task.objects.filter(Q(scheduled_time__lte=timezone.now()) | Q(scheduled_time=None), completed=None).first()
-            if task is None:
-                time.sleep(1)
-                run_regular_tasks()
-                continue
+    help = "Run queued tasks with a pool of workers, finishing running tasks before exiting on SIGTERM"
 
-            try:
-                split = task.job.split(".")
-                module = __import__(split[0])
-                fn = reduce(getattr, split[1:], module)
-
-                print(task.job, fn, task.args, task.kwargs)
-                task.started = timezone.now()
-                task.save()
-                fn(*task.args, **task.kwargs)
-                task.completed = timezone.now()
-                task.save()
-            except Exception as e:
-                task.completed = timezone.now()
-                task.error = e
-                task.save()
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--concurrency',
+                            type=int,
+                            default=1,
+                            help='Number of workers to run')
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument('--threads',
+                          dest='processes',
+                          action='store_false',
+                          help='Run workers as threads (default)')
+        mode.add_argument('--processes',
+                          dest='processes',
+                          action='store_true',
+                          help='Run workers as forked processes, so recycling them frees their memory')
+        # Both flags share the processes dest, so without this argparse takes the default from --processes
+        parser.set_defaults(processes=False)
+        parser.add_argument('--max-tasks',
+                            type=int,
+                            default=settings.TASK_WORKER_MAX_TASKS,
+                            help='Restart each worker after it runs this many tasks, 0 to never restart')
+        parser.add_argument('-q', '--queues',
+                            help='Comma separated queues to serve, each optionally weighted like cache:3,links:1. '
+                                 'Defaults to every queue, highest priority first')
 
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+        queues = None
+        if options['queues']:
+            try:
+                queues = parse_queues(options['queues'])
+            except ValueError as e:
+                raise CommandError(e)
+        WorkerPool(options['concurrency'], processes=options['processes'],
+                   max_tasks=options['max_tasks'] or None, queues=queues).run()
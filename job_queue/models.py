@@ -1,14 +1,49 @@
 from django.db import models
 
+DEFAULT_QUEUE = 'default'
+
 # Create your models here.
 class Task(models.Model):
     job = models.CharField(max_length=100)
     args = models.JSONField()
     kwargs = models.JSONField()
     scheduled_time = models.DateTimeField(null=True, blank=True)
+    # run_queue can serve a subset of queues, and runs the highest priority due tasks first
+    queue = models.CharField(max_length=50, default=DEFAULT_QUEUE)
+    priority = models.SmallIntegerField(default=0)
 
     created = models.DateTimeField(auto_now_add=True)
     started = models.DateTimeField(null=True, blank=True)
     completed = models.DateTimeField(null=True, blank=True)
+    # The run_queue worker that claimed the task, and when its claim runs out unless renewed
+    worker = models.CharField(max_length=100, null=True, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    # Identifies equivalent tasks while this one is waiting to run, so they're merged into it instead of queued again
+    dedupe_key = models.CharField(max_length=255, null=True, blank=True, unique=True)
 
+    # The traceback of the latest failure
     error = models.TextField(null=True, blank=True)
+    # Each attempt's worker, start and finish times, and traceback if it failed
+    attempts = models.PositiveIntegerField(default=0)
+    history = models.JSONField(default=list, blank=True)
+    # Set (along with completed) when the task failed on every attempt its job's policy allows
+    dead = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # For workers looking for due, uncompleted tasks
+            models.Index(fields=['completed', 'scheduled_time'], name='task_due_idx'),
+            models.Index(fields=['queue', 'completed', 'priority', 'scheduled_time'], name='task_claim_idx'),
+        ]
+
+
+class PeriodicJob(models.Model):
+    """When each job in settings.PERIODIC_JOBS last ran and is next due, shared by every worker"""
+    name = models.CharField(max_length=100, unique=True)
+    # The schedule next_run was worked out from, so a changed schedule takes effect straight away
+    schedule = models.CharField(max_length=100)
+    last_run = models.DateTimeField(null=True, blank=True)
+    next_run = models.DateTimeField()
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,77 @@
+"""
+Wakes idle queue workers as soon as a task is added.
+
+Each worker binds a Unix datagram socket in TASK_NOTIFY_DIR, and add_task
+sends a byte to every socket there once its transaction commits. Workers on
+other hosts, or that couldn't bind a socket, aren't notified and fall back
+to polling.
+"""
+import os
+import select
+import socket
+from pathlib import Path
+
+from django.conf import settings
+
+
+def socket_paths():
+    try:
+        return list(Path(settings.TASK_NOTIFY_DIR).glob('*.sock'))
+    except OSError:
+        return []
+
+
+def notify_workers():
+    """Wake every worker listening on this host"""
+    paths = socket_paths()
+    if not paths:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+        sender.setblocking(False)
+        for path in paths:
+            try:
+                sender.sendto(b'!', str(path))
+            except BlockingIOError:
+                pass  # Its buffer is full of notifications it hasn't read yet, so it will wake anyway
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a worker that was killed
+                path.unlink(missing_ok=True)
+            except OSError as e:
+                print(f'Failed to notify queue worker at {path}: {e}')
+
+
+class TaskListener:
+    """A worker's notification socket. If it can't be bound, wait() just sleeps for the timeout"""
+    def __init__(self, worker):
+        self.path = Path(settings.TASK_NOTIFY_DIR) / f'{worker}.sock'
+        self.socket = None
+        try:
+            os.makedirs(self.path.parent, exist_ok=True)
+            self.path.unlink(missing_ok=True)
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.socket.bind(str(self.path))
+            self.socket.setblocking(False)
+        except OSError as e:
+            print(f'Queue worker {worker} falling back to polling, could not listen on {self.path}: {e}')
+            self.close()
+
+    def wait(self, timeout, stop):
+        """Block until notified (returning True), stop is set, or timeout seconds pass"""
+        if self.socket is None:
+            stop.wait(timeout)
+            return False
+        readable, _, _ = select.select([self.socket], [], [], timeout)
+        if not readable:
+            return False
+        # Several tasks may have been added since the last wait, they only need to wake the worker once
+        while True:
+            try:
+                self.socket.recv(64)
+            except (BlockingIOError, InterruptedError):
+                return True
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+            self.path.unlink(missing_ok=True)
@@ -0,0 +1,148 @@
+"""
+Queues the jobs in settings.PERIODIC_JOBS when they're due.
+
+Each job runs every 'interval' seconds, or on a five field 'cron' schedule
+(minute hour day-of-month month day-of-week, in local time), delayed by up to
+'jitter' seconds. When a job is due, one pool claims it by moving its
+PeriodicJob row's next_run forward with a compare-and-set update, then queues
+it as a normal task. Several pools or hosts can therefore run the scheduler
+without queueing a job twice, and the schedule survives restarts.
+"""
+import random
+import traceback
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import DEFAULT_QUEUE, PeriodicJob
+from .utils import add_task, resolve_job
+
+CRON_FIELDS = (
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day', 1, 31),
+    ('month', 1, 12),
+    ('weekday', 0, 7),
+)
+
+
+def parse_cron_field(field, low, high):
+    """The set of values matched by a cron field like '*', '*/15', '1-5' or '0,30'"""
+    values = set()
+    for part in field.split(','):
+        spec, _, step = part.partition('/')
+        if spec == '*':
+            start, end = low, high
+        elif '-' in spec:
+            start, end = (int(value) for value in spec.split('-', 1))
+        else:
+            start = end = int(spec)
+        if step and spec != '*' and '-' not in spec:
+            end = high
+        if start < low or end > high or start > end:
+            raise ValueError(f"Cron field {field} out of range {low}-{high}")
+        values.update(range(start, end + 1, int(step or 1)))
+    return values
+
+
+def parse_cron(spec):
+    fields = spec.split()
+    if len(fields) != len(CRON_FIELDS):
+        raise ValueError(f"Cron schedule {spec!r} should have {len(CRON_FIELDS)} fields")
+    parsed = {name: parse_cron_field(field, low, high) for field, (name, low, high) in zip(fields, CRON_FIELDS)}
+    # Sunday can be 0 or 7
+    if 7 in parsed['weekday']:
+        parsed['weekday'] = parsed['weekday'] - {7} | {0}
+    # Like cron, a job restricted by both day of month and day of week runs on days matching either
+    parsed['any_day'] = fields[2] != '*' and fields[4] != '*'
+    return parsed
+
+
+def cron_day_matches(cron, day):
+    if day.month not in cron['month']:
+        return False
+    day_matches = day.day in cron['day']
+    weekday_matches = (day.weekday() + 1) % 7 in cron['weekday']
+    return day_matches or weekday_matches if cron['any_day'] else day_matches and weekday_matches
+
+
+def next_cron_time(spec, after):
+    """The first time after after (aware) matching the cron schedule spec, in the current timezone"""
+    cron = parse_cron(spec)
+    local = timezone.localtime(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    day = local.date()
+    # A matching day comes around within a few years, even for schedules like February 29th
+    for _ in range(366 * 8):
+        if cron_day_matches(cron, day):
+            for hour in sorted(cron['hour']):
+                for minute in sorted(cron['minute']):
+                    candidate = timezone.make_aware(datetime(day.year, day.month, day.day, hour, minute))
+                    if candidate >= local:
+                        return candidate
+        day += timedelta(days=1)
+    raise ValueError(f"Cron schedule {spec!r} never runs")
+
+
+def schedule_description(spec):
+    return f"cron {spec['cron']}" if 'cron' in spec else f"every {spec['interval']}s"
+
+
+def next_run_time(spec, after):
+    if 'cron' in spec:
+        next_run = next_cron_time(spec['cron'], after)
+    else:
+        next_run = after + timedelta(seconds=spec['interval'])
+    return next_run + timedelta(seconds=random.uniform(0, spec.get('jitter', 0)))
+
+
+def queue_periodic_job(name, spec):
+    job = resolve_job(spec['job'])
+    # Merged into the last run if that's still waiting, rather than piling up while the queue is busy
+    add_task(job, *spec.get('args', ()), queue=spec.get('queue', DEFAULT_QUEUE), priority=spec.get('priority', 0),
+             dedupe_key=f"periodic:{name}", **spec.get('kwargs', {}))
+
+
+def schedule_periodic_jobs(now=None):
+    """Queue every periodic job that's due, returning the seconds until the next one is"""
+    now = now or timezone.now()
+    next_due = None
+    jobs = {job.name: job for job in PeriodicJob.objects.filter(name__in=settings.PERIODIC_JOBS)}
+    for name, spec in settings.PERIODIC_JOBS.items():
+        schedule = schedule_description(spec)
+        job = jobs.get(name)
+        if job is None or job.schedule != schedule:
+            # New or rescheduled jobs run straight away, then follow the schedule
+            try:
+                with transaction.atomic():
+                    job, _ = PeriodicJob.objects.update_or_create(
+                        name=name, defaults={'schedule': schedule, 'next_run': now})
+            except IntegrityError:
+                # Created by another pool at the same time
+                job = PeriodicJob.objects.get(name=name)
+
+        if job.next_run <= now:
+            next_run = next_run_time(spec, now)
+            try:
+                # Claimed and queued together, so a failure to queue the job leaves it due
+                with transaction.atomic():
+                    claimed = PeriodicJob.objects.filter(name=name, next_run=job.next_run) \
+                        .update(next_run=next_run, last_run=now)
+                    if claimed:
+                        print(f"Queueing periodic job {name}, next run at {next_run}")
+                        queue_periodic_job(name, spec)
+            except Exception:
+                print(f"Failed to queue periodic job {name}")
+                traceback.print_exc()
+                continue
+            if not claimed:
+                # Claimed by another pool, which will have moved next_run forward
+                job.refresh_from_db()
+                next_run = job.next_run
+        else:
+            next_run = job.next_run
+
+        seconds = (next_run - now).total_seconds()
+        next_due = seconds if next_due is None else min(next_due, seconds)
+    return next_due
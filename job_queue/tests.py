@@ -1,3 +1,350 @@
-from django.test import TestCase
+import os
+import signal
+import socket
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from .models import PeriodicJob, Task
+from .notify import TaskListener, notify_workers
+from .periodic import next_cron_time, parse_cron, schedule_periodic_jobs
+from .utils import add_task, add_tasks, claim_task, enqueue_on_commit, make_task, task_policy
+from .worker import TaskFailed, run_task, run_with_timeout
+
+
+class RunQueueCommandTests(SimpleTestCase):
+    def run_queue(self, *args):
+        with mock.patch('job_queue.management.commands.run_queue.WorkerPool') as pool:
+            call_command('run_queue', *args)
+        return pool
+
+    def test_defaults_to_threads(self):
+        pool = self.run_queue()
+        self.assertFalse(pool.call_args.kwargs['processes'])
+        pool.return_value.run.assert_called_once_with()
+
+    def test_mode_flags(self):
+        self.assertTrue(self.run_queue('--processes').call_args.kwargs['processes'])
+        self.assertFalse(self.run_queue('--threads').call_args.kwargs['processes'])
+
+
+def interrupted_job(path):
+    # SIGTERM sent to the worker's process group also reaches its task children
+    os.kill(os.getpid(), signal.SIGTERM)
+    with open(path, 'w') as f:
+        f.write('finished')
+
+
+def failing_job():
+    raise ValueError('broken')
+
+
+@task_policy(retries=1, backoff=10, max_backoff=10)
+def retried_job():
+    raise ValueError('broken')
+
+
+def noop_job(*args, **kwargs):
+    pass
+
+
+def merge_first_args(args, kwargs, other_args, other_kwargs):
+    return [args[0] + other_args[0]], {**kwargs, **other_kwargs}
+
+
+class RunWithTimeoutTests(SimpleTestCase):
+    def test_child_finishes_after_sigterm(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'result')
+            run_with_timeout('job_queue.tests.interrupted_job', [path], {}, 10)
+            with open(path) as f:
+                self.assertEqual(f.read(), 'finished')
+
+    def test_kills_child_on_timeout(self):
+        start = time.monotonic()
+        with self.assertRaisesRegex(TaskFailed, 'Timed out'):
+            run_with_timeout('time.sleep', [30], {}, 0.5)
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_reports_child_traceback(self):
+        with self.assertRaisesRegex(TaskFailed, 'ValueError: broken'):
+            run_with_timeout('job_queue.tests.failing_job', [], {}, 10)
+
+
+@override_settings(PERIODIC_JOBS={'failing': {'job': 'job_queue.tests.failing_job', 'interval': 60}})
+class SchedulePeriodicJobsTests(TestCase):
+    def test_queues_new_job(self):
+        now = timezone.now()
+        with redirect_stdout(StringIO()):
+            self.assertEqual(schedule_periodic_jobs(now), 60)
+        self.assertEqual(Task.objects.get().job, 'job_queue.tests.failing_job')
+        self.assertEqual(PeriodicJob.objects.get().last_run, now)
+        self.assertEqual(schedule_periodic_jobs(now), 60)
+        self.assertEqual(Task.objects.count(), 1)
+
+    def test_job_saved_by_another_pool(self):
+        now = timezone.now()
+        PeriodicJob.objects.create(name='failing', schedule='every 30s', next_run=now + timedelta(seconds=30))
+        # Another pool inserts or updates the row between this one reading and saving it
+        with mock.patch.object(PeriodicJob.objects, 'update_or_create', side_effect=IntegrityError):
+            self.assertEqual(schedule_periodic_jobs(now), 30)
+        self.assertFalse(Task.objects.exists())
+
+
+# The compare-and-set claim used where the database has no SELECT ... FOR UPDATE SKIP LOCKED
+@mock.patch.object(connection.features, 'has_select_for_update_skip_locked', False)
+class ClaimTaskTests(TestCase):
+    def test_claims_due_tasks_in_order(self):
+        now = timezone.now()
+        later = add_task(noop_job, scheduled_time=now - timedelta(minutes=1))
+        earlier = add_task(noop_job, scheduled_time=now - timedelta(minutes=2))
+        add_task(noop_job, scheduled_time=now + timedelta(minutes=1))
+
+        self.assertEqual([claim_task('w').pk for _ in range(2)], [earlier.pk, later.pk])
+        self.assertIsNone(claim_task('w'))
+
+    def test_claim_sets_lease(self):
+        add_task(noop_job)
+        task = claim_task('w')
+        self.assertEqual(task.worker, 'w')
+        self.assertEqual(task.started, Task.objects.get().started)
+        self.assertGreater(task.lease_expires, timezone.now())
+
+    def test_reclaims_expired_lease(self):
+        task = add_task(noop_job)
+        claim_task('a')
+        self.assertIsNone(claim_task('b'))
+        Task.objects.filter(pk=task.pk).update(lease_expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(claim_task('b').worker, 'b')
+
+
+class AddDeduplicatedTaskTests(TestCase):
+    def add(self, *args, **kwargs):
+        with redirect_stdout(StringIO()):
+            return add_task(noop_job, *args, dedupe_key='key', **kwargs)
+
+    def test_replace(self):
+        task = self.add([1], flag=True)
+        self.assertEqual(self.add([2]).pk, task.pk)
+        task = Task.objects.get()
+        self.assertEqual((task.args, task.kwargs), ([[2]], {}))
+
+    def test_union(self):
+        self.add([1, 2], 'a', urls=['/a/'])
+        self.add([2, 3], 'b', urls=['/b/'], merge='union')
+        task = Task.objects.get()
+        self.assertEqual(task.args, [[1, 2, 3], 'b'])
+        self.assertEqual(task.kwargs, {'urls': ['/a/', '/b/']})
+
+    def test_callable(self):
+        self.add(1, a=1)
+        self.add(2, b=2, merge=merge_first_args)
+        task = Task.objects.get()
+        self.assertEqual((task.args, task.kwargs), ([3], {'a': 1, 'b': 2}))
+
+    def test_keeps_earliest_time_and_highest_priority(self):
+        now = timezone.now()
+        self.add(scheduled_time=now + timedelta(minutes=5), priority=5)
+        self.add(scheduled_time=now + timedelta(minutes=10), priority=1)
+        task = Task.objects.get()
+        self.assertEqual((task.scheduled_time, task.priority), (now + timedelta(minutes=5), 5))
+
+        self.add(scheduled_time=now + timedelta(minutes=1))
+        self.assertEqual(Task.objects.get().scheduled_time, now + timedelta(minutes=1))
+        # Unscheduled tasks run as soon as possible, the earliest time of all
+        self.add()
+        self.assertIsNone(Task.objects.get().scheduled_time)
+        self.add(scheduled_time=now)
+        self.assertIsNone(Task.objects.get().scheduled_time)
+
+    @mock.patch.object(connection.features, 'has_select_for_update_skip_locked', False)
+    def test_running_task_is_not_merged_into(self):
+        task = self.add([1])
+        self.assertIsNone(claim_task('w').dedupe_key)
+        self.assertNotEqual(self.add([2]).pk, task.pk)
+
+
+@mock.patch.object(connection.features, 'has_select_for_update_skip_locked', False)
+class QueuePriorityTests(TestCase):
+    def test_claims_highest_priority_first(self):
+        now = timezone.now()
+        due = add_task(noop_job, scheduled_time=now - timedelta(minutes=1))
+        urgent = add_task(noop_job, priority=5)
+        background = add_task(noop_job, scheduled_time=now - timedelta(minutes=2), priority=-5)
+        self.assertEqual([claim_task('w').pk for _ in range(3)], [urgent.pk, due.pk, background.pk])
+
+    def test_only_claims_from_queues(self):
+        add_task(noop_job, queue='links')
+        self.assertIsNone(claim_task('w', ['cache']))
+        self.assertEqual(claim_task('w', ['cache', 'links']).queue, 'links')
+
+
+class RunTaskTests(TestCase):
+    def run_claimed(self, job):
+        add_task(job)
+        task = claim_task('w')
+        with redirect_stdout(StringIO()):
+            run_task(task, 'w')
+        task.refresh_from_db()
+        return task
+
+    def test_completes(self):
+        task = self.run_claimed(noop_job)
+        self.assertIsNotNone(task.completed)
+        self.assertIsNone(task.dead)
+        self.assertEqual(task.attempts, 1)
+        self.assertIsNone(task.history[0]['error'])
+
+    def test_retries_then_dies(self):
+        task = self.run_claimed(retried_job)
+        self.assertIsNone(task.completed)
+        self.assertIsNone(task.worker)
+        self.assertIsNone(task.started)
+        self.assertIn('ValueError: broken', task.error)
+        self.assertGreater(task.scheduled_time, timezone.now())
+
+        Task.objects.filter(pk=task.pk).update(scheduled_time=timezone.now())
+        task = claim_task('w')
+        with redirect_stdout(StringIO()):
+            run_task(task, 'w')
+        task.refresh_from_db()
+        self.assertEqual(task.attempts, 2)
+        self.assertEqual(task.dead, task.completed)
+        self.assertIsNotNone(task.dead)
+        self.assertEqual([attempt['attempt'] for attempt in task.history], [1, 2])
+
+    def test_missing_job_dies_without_retrying(self):
+        Task.objects.create(job='job_queue.tests.missing_job', args=[], kwargs={})
+        task = claim_task('w')
+        with redirect_stdout(StringIO()):
+            run_task(task, 'w')
+        task.refresh_from_db()
+        self.assertEqual(task.attempts, 1)
+        self.assertIsNotNone(task.dead)
+
+
+class BulkTaskTests(TestCase):
+    def test_add_tasks_in_batches(self):
+        tasks = (make_task(noop_job, i, queue='links') for i in range(5))
+        # An insert per batch
+        with self.assertNumQueries(3):
+            self.assertEqual(add_tasks(tasks, batch_size=2), 5)
+        self.assertEqual(sorted(Task.objects.values_list('args', flat=True)), [[i] for i in range(5)])
+        self.assertEqual(set(Task.objects.values_list('queue', flat=True)), {'links'})
+
+    def test_add_tasks_merges_deduplicated(self):
+        tasks = [make_task(noop_job, [i], dedupe_key='key') for i in range(3)] + [make_task(noop_job)]
+        with redirect_stdout(StringIO()):
+            self.assertEqual(add_tasks(tasks, merge='union'), 4)
+        self.assertEqual(Task.objects.count(), 2)
+        self.assertEqual(Task.objects.get(dedupe_key='key').args, [[0, 1, 2]])
+
+    def test_enqueue_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue_on_commit(noop_job, 1)
+            self.assertFalse(Task.objects.exists())
+        self.assertEqual(Task.objects.get().args, [1])
+
+    def test_enqueue_rolled_back(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(ValueError), transaction.atomic():
+                enqueue_on_commit(noop_job)
+                raise ValueError
+        self.assertEqual(callbacks, [])
+        self.assertFalse(Task.objects.exists())
+
+
+class NotifyTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.settings = override_settings(TASK_NOTIFY_DIR=directory.name)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        self.directory = directory.name
+
+    def listen(self):
+        listener = TaskListener('w')
+        self.addCleanup(listener.close)
+        return listener
+
+    def test_wakes_listener(self):
+        listener = self.listen()
+        self.assertFalse(listener.wait(0, threading.Event()))
+        notify_workers()
+        notify_workers()
+        self.assertTrue(listener.wait(5, threading.Event()))
+        # Both notifications are read by the one wakeup
+        self.assertFalse(listener.wait(0, threading.Event()))
+
+    def test_notifies_after_commit(self):
+        with mock.patch('job_queue.utils.notify_workers') as notify:
+            with self.captureOnCommitCallbacks(execute=True):
+                add_task(noop_job)
+                notify.assert_not_called()
+        notify.assert_called_once_with()
+
+    def test_removes_dead_worker_sockets(self):
+        path = os.path.join(self.directory, 'dead.sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as dead:
+            dead.bind(path)
+        listener = self.listen()
+        notify_workers()
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(listener.wait(5, threading.Event()))
+
+    def test_polls_without_socket(self):
+        with override_settings(TASK_NOTIFY_DIR=os.path.join(self.directory, 'x' * 200)), redirect_stdout(StringIO()):
+            listener = self.listen()
+        self.assertIsNone(listener.socket)
+        stop = threading.Event()
+        stop.set()
+        self.assertFalse(listener.wait(5, stop))
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=dt_timezone.utc)
+
+
+class CronTests(SimpleTestCase):
+    def test_parse_fields(self):
+        cron = parse_cron('*/15 9-17/4 1,15 * 7')
+        self.assertEqual(cron['minute'], {0, 15, 30, 45})
+        self.assertEqual(cron['hour'], {9, 13, 17})
+        self.assertEqual(cron['day'], {1, 15})
+        self.assertEqual(cron['month'], set(range(1, 13)))
+        self.assertEqual(cron['weekday'], {0})
+        self.assertEqual(parse_cron('5/20 * * * *')['minute'], {5, 25, 45})
+
+    def test_invalid(self):
+        for spec in ('* * * *', '60 * * * *', '* 5-3 * * *', '* * 0 * *'):
+            with self.assertRaises(ValueError):
+                parse_cron(spec)
+
+    @timezone.override('UTC')
+    def test_next_time(self):
+        # Strictly after, on minute boundaries
+        self.assertEqual(next_cron_time('*/15 * * * *', utc(2024, 1, 1, 10, 15)), utc(2024, 1, 1, 10, 30))
+        self.assertEqual(next_cron_time('*/15 * * * *', utc(2024, 1, 1, 10, 14, 59)), utc(2024, 1, 1, 10, 15))
+        self.assertEqual(next_cron_time('30 3 * * *', utc(2024, 1, 1, 3, 30)), utc(2024, 1, 2, 3, 30))
+        # Mondays to Fridays, 2024-01-06 being a Saturday
+        self.assertEqual(next_cron_time('0 9 * * 1-5', utc(2024, 1, 5, 10)), utc(2024, 1, 8, 9))
+        self.assertEqual(next_cron_time('0 0 29 2 *', utc(2024, 3, 1)), utc(2028, 2, 29))
+
+    @timezone.override('UTC')
+    def test_day_of_month_or_week(self):
+        # The 13th or any Friday, 2024-01-05 being a Friday
+        self.assertEqual(next_cron_time('0 0 13 * 5', utc(2024, 1, 1)), utc(2024, 1, 5))
+        self.assertEqual(next_cron_time('0 0 13 * 5', utc(2024, 1, 12, 1)), utc(2024, 1, 13))
+        # Only one restricted, both must match
+        self.assertEqual(next_cron_time('0 0 13 * *', utc(2024, 1, 1)), utc(2024, 1, 13))
+        self.assertEqual(next_cron_time('0 0 * 2 5', utc(2024, 1, 1)), utc(2024, 2, 2))
@@ -1,11 +1,233 @@
-from .models import Task
+import importlib
+import os
+import random
+import socket
+import uuid
+from dataclasses import dataclass
+from datetime import timedelta
+from functools import reduce
+from itertools import islice
+from typing import Optional
 
-def run_regular_tasks():
-    from main.models import check_links
-    check_links()
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Min, Q
+from django.utils import timezone
 
-def add_task(job, *args, scheduled_time=None, **kwargs):
+from .models import DEFAULT_QUEUE, Task
+from .notify import notify_workers
+
+def make_task(job, *args, scheduled_time=None, queue=DEFAULT_QUEUE, priority=0, dedupe_key=None, **kwargs):
+    """An unsaved Task to run job(*args, **kwargs), for add_tasks"""
     job_str = f"{job.__module__}.{job.__name__}"
-    task = Task(job=job_str, scheduled_time=scheduled_time, args=args, kwargs=kwargs)
-    task.save()
+    return Task(job=job_str, scheduled_time=scheduled_time, args=args, kwargs=kwargs, queue=queue, priority=priority,
+                dedupe_key=dedupe_key)
+
+def add_task(job, *args, merge='replace', **kwargs):
+    """
+    Queue job(*args, **kwargs) to run at scheduled_time, or as soon as possible. Workers serving queue run its
+    highest priority tasks first. If a task with the same dedupe_key is still waiting to run, it is merged into that
+    task instead of queueing another (see merge_task_arguments)
+    """
+    task = make_task(job, *args, **kwargs)
+    if task.dedupe_key is None:
+        task.save()
+    else:
+        task = add_deduplicated_task(task, merge)
+    # Workers can't claim the task until it's committed. Runs straight away outside of a transaction
+    transaction.on_commit(notify_workers)
+    return task
+
+def add_tasks(tasks, batch_size=500, merge='replace'):
+    """
+    Queue an iterable of make_task Tasks, inserting them batch_size at a time so a generator can stream them without
+    holding them all in memory. Returns the number of tasks queued or merged
+    """
+    count = 0
+    tasks = iter(tasks)
+    while batch := list(islice(tasks, batch_size)):
+        Task.objects.bulk_create([task for task in batch if task.dedupe_key is None])
+        # Deduplicated tasks may need merging, so can't be inserted in bulk
+        for task in batch:
+            if task.dedupe_key is not None:
+                add_deduplicated_task(task, merge)
+        count += len(batch)
+    if count:
+        transaction.on_commit(notify_workers)
+    return count
+
+def enqueue_on_commit(job, *args, **kwargs):
+    """
+    add_task once the current transaction commits, and not at all if it rolls back, so a task never refers to rows
+    that were never saved. Runs straight away outside of a transaction
+    """
+    transaction.on_commit(lambda: add_task(job, *args, **kwargs))
+
+def union(value, other):
+    if isinstance(value, list) and isinstance(other, (list, tuple)):
+        return value + [item for item in other if item not in value]
+    return other
+
+def merge_task_arguments(args, kwargs, other_args, other_kwargs, merge):
+    """
+    Merge a waiting task's arguments with a new task's. merge is 'replace' to keep the new task's arguments, 'union'
+    to combine list arguments (keeping the new value of anything else), or a function taking both tasks' args and
+    kwargs and returning the merged args and kwargs
+    """
+    if callable(merge):
+        return merge(args, kwargs, list(other_args), other_kwargs)
+    if merge == 'replace':
+        return list(other_args), other_kwargs
+    if merge == 'union':
+        merged_args = [union(value, other) for value, other in zip(args, other_args)] + list(other_args[len(args):])
+        merged_kwargs = {**kwargs, **{key: union(kwargs.get(key), other) for key, other in other_kwargs.items()}}
+        return merged_args, merged_kwargs
+    raise ValueError(f"Unknown task merge {merge!r}")
+
+def add_deduplicated_task(new_task, merge):
+    # The unique index on dedupe_key means concurrent adds can't both create a task, the loser merges instead
+    for _ in range(3):
+        with transaction.atomic():
+            task = Task.objects.select_for_update().filter(dedupe_key=new_task.dedupe_key).first()
+            if task is None:
+                try:
+                    with transaction.atomic():
+                        new_task.save()
+                        return new_task
+                except IntegrityError:
+                    new_task.pk = None
+                    continue
+
+            task.args, task.kwargs = merge_task_arguments(task.args, task.kwargs, new_task.args, new_task.kwargs,
+                                                          merge)
+            # Run at the earlier of the two times and the higher priority, so merging never delays the waiting task
+            scheduled_time = new_task.scheduled_time
+            if scheduled_time is None or (task.scheduled_time is not None and scheduled_time < task.scheduled_time):
+                task.scheduled_time = scheduled_time
+            task.priority = max(task.priority, new_task.priority)
+            task.save(update_fields=['args', 'kwargs', 'scheduled_time', 'priority'])
+            print(f"Merged {new_task.job} into waiting task {task.pk} ({task.dedupe_key})")
+            return task
+    raise RuntimeError(f"Couldn't add or merge task {new_task.dedupe_key}")
+
+@dataclass
+class TaskPolicy:
+    # Times to retry a failed task, waiting backoff seconds before the first retry and doubling each time after
+    retries: int
+    backoff: float
+    max_backoff: float
+    # Seconds before the job is killed and counted as failed, or None to run it in the worker without a limit
+    timeout: Optional[float] = None
+
+    def retry_delay(self, attempt):
+        """Seconds to wait after the given failed attempt, with jitter so failed tasks don't all retry at once"""
+        return min(self.backoff * 2 ** (attempt - 1), self.max_backoff) * random.uniform(0.5, 1)
+
+def default_policy():
+    return TaskPolicy(settings.TASK_DEFAULT_RETRIES, settings.TASK_RETRY_BACKOFF, settings.TASK_RETRY_MAX_BACKOFF)
+
+def task_policy(retries=None, backoff=None, max_backoff=None, timeout=None):
+    """Set how a job's tasks are retried and time limited, in place of the TASK_DEFAULT_* settings"""
+    def decorator(job):
+        job.task_policy = lambda: TaskPolicy(
+            settings.TASK_DEFAULT_RETRIES if retries is None else retries,
+            settings.TASK_RETRY_BACKOFF if backoff is None else backoff,
+            settings.TASK_RETRY_MAX_BACKOFF if max_backoff is None else max_backoff,
+            timeout,
+        )
+        return job
+    return decorator
+
+def job_policy(job):
+    policy = getattr(job, 'task_policy', None)
+    return policy() if policy is not None else default_policy()
+
+def resolve_job(job):
+    """The function a job path like main.models.check_links names, importing its module if it isn't already"""
+    split = job.split(".")
+    for i in range(len(split) - 1, 0, -1):
+        module_path = ".".join(split[:i])
+        try:
+            module = importlib.import_module(module_path)
+        except ModuleNotFoundError as e:
+            # Only skip a path that isn't a module, not a module failing to import one of its dependencies
+            if e.name is None or not module_path.startswith(e.name):
+                raise
+            continue
+        return reduce(getattr, split[i:], module)
+    raise ImportError(f"No module found for job {job}")
+
+def rerun_task(task):
+    """Queue a completed or dead task to run again straight away, keeping its history"""
+    task.started = None
+    task.completed = None
+    task.dead = None
+    task.worker = None
+    task.lease_expires = None
+    task.scheduled_time = None
+    task.attempts = 0
+    task.save(update_fields=['started', 'completed', 'dead', 'worker', 'lease_expires', 'scheduled_time',
+                             'attempts'])
+    transaction.on_commit(notify_workers)
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def claimable(now, queues=None):
+    """Tasks in queues (or any queue) that are due and either unclaimed or whose worker's lease has run out"""
+    tasks = Task.objects.filter(
+        Q(scheduled_time__lte=now) | Q(scheduled_time=None),
+        Q(started=None) | Q(lease_expires__lt=now),
+        completed=None,
+    )
+    if queues is not None:
+        tasks = tasks.filter(queue__in=queues)
+    return tasks
+
+# Highest priority first, then in the order they were due
+CLAIM_ORDER = ('-priority', 'scheduled_time', 'id')
+
+def claim_task(worker, queues=None):
+    """
+    Atomically claim the next due task in queues (or any queue) for worker, returning None if there isn't one. Uses
+    SELECT ... FOR UPDATE SKIP LOCKED where the database supports it, so concurrent workers each get a different task
+    without waiting.
+    """
+    now = timezone.now()
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            task = claimable(now, queues).select_for_update(skip_locked=True).order_by(*CLAIM_ORDER).first()
+            if task is None:
+                return None
+            task.started = now
+            task.worker = worker
+            task.lease_expires = now + timedelta(seconds=settings.TASK_LEASE_SECONDS)
+            # Tasks added with the same key from now on are queued separately, rather than merged into a running task
+            task.dedupe_key = None
+            task.save(update_fields=['started', 'worker', 'lease_expires', 'dedupe_key'])
+            return task
+
+    # Compare-and-set: the update only matches if no other worker claimed the task since it was read
+    for pk in claimable(now, queues).order_by(*CLAIM_ORDER).values_list('id', flat=True)[:10]:
+        claimed = claimable(now).filter(pk=pk).update(
+            started=now, worker=worker, lease_expires=now + timedelta(seconds=settings.TASK_LEASE_SECONDS),
+            dedupe_key=None,
+        )
+        if claimed:
+            return Task.objects.get(pk=pk)
+    return None
+
+def renew_lease(task, worker):
+    """Extend worker's claim on task, returning False if the lease was lost to another worker"""
+    lease_expires = timezone.now() + timedelta(seconds=settings.TASK_LEASE_SECONDS)
+    renewed = Task.objects.filter(pk=task.pk, worker=worker, completed=None).update(lease_expires=lease_expires)
+    return renewed > 0
 
+def seconds_until_next_task(queues=None, now=None):
+    """Seconds until the next scheduled task in queues (or any queue) is due, or None if no tasks are scheduled"""
+    now = now or timezone.now()
+    tasks = Task.objects.filter(completed=None, started=None, scheduled_time__gt=now)
+    if queues is not None:
+        tasks = tasks.filter(queue__in=queues)
+    next_time = tasks.aggregate(next_time=Min('scheduled_time'))['next_time']
+    return None if next_time is None else (next_time - now).total_seconds()
@@ -0,0 +1,313 @@
+"""
+Queue workers and the pool run_queue uses to supervise them.
+
+Each worker claims and runs tasks until it is told to stop, when it finishes
+its current task first. Workers run as threads or forked processes, and are
+restarted if they crash or after running max_tasks tasks. Jobs with a
+timeout run in a spawned child that is killed if it overruns. The pool's
+supervisor queues periodic jobs as they come due.
+"""
+import multiprocessing
+import random
+import signal
+import threading
+import time
+import traceback
+from datetime import timedelta
+
+import django
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.utils import timezone
+
+from .notify import TaskListener, notify_workers
+from .periodic import schedule_periodic_jobs
+from .utils import (
+    TaskPolicy, claim_task, job_policy, renew_lease, resolve_job, seconds_until_next_task, worker_id
+)
+
+
+class LeaseRenewer(threading.Thread):
+    """Keeps renewing the worker's lease on a task until stopped, so long tasks aren't claimed by another worker"""
+    def __init__(self, task, worker):
+        super().__init__(daemon=True)
+        self.task = task
+        self.worker = worker
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(settings.TASK_LEASE_RENEW_INTERVAL):
+                if not renew_lease(self.task, self.worker):
+                    print(f"Lost lease on task {self.task.pk} ({self.task.job})")
+                    return
+        finally:
+            connections.close_all()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class TaskFailed(Exception):
+    """A job run in a child process failed, with the child's traceback as the message"""
+
+
+def run_child(sender, job, args, kwargs):
+    # Like the workers, finish the job when SIGTERM or SIGINT is sent to the whole process group
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        django.setup()
+        resolve_job(job)(*args, **kwargs)
+        sender.send(None)
+    except BaseException:
+        sender.send(traceback.format_exc())
+    finally:
+        connections.close_all()
+
+
+def run_with_timeout(job, args, kwargs, timeout):
+    """Run the job at path job in a child process, killing it if it runs for longer than timeout seconds"""
+    # Spawned rather than forked, as a fork copies locks held by the worker's other threads (like the lease
+    # renewer's) and the child would wait on them forever. The child sets Django up and opens its own connections
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    child = context.Process(target=run_child, args=(sender, job, args, kwargs))
+    child.start()
+    sender.close()
+    try:
+        # The child always sends its result before exiting, or closes the pipe if it dies
+        if not receiver.poll(timeout):
+            # The child ignores SIGTERM, so it can only be stopped with SIGKILL
+            child.kill()
+            raise TaskFailed(f"Timed out after {timeout} seconds")
+        try:
+            error = receiver.recv()
+        except EOFError:
+            error = None
+        child.join()
+        if error is not None:
+            raise TaskFailed(error)
+        if child.exitcode != 0:
+            raise TaskFailed(f"Exited with code {child.exitcode}")
+    finally:
+        child.join()
+        receiver.close()
+
+
+def run_task(task, worker):
+    """Run a claimed task, then mark it completed, schedule a retry, or mark it dead if it has no retries left"""
+    renewer = LeaseRenewer(task, worker)
+    renewer.start()
+    started = timezone.now()
+    task.attempts += 1
+    error = None
+    try:
+        try:
+            job = resolve_job(task.job)
+        except (ImportError, AttributeError):
+            # Retrying won't make the job appear
+            policy = TaskPolicy(retries=0, backoff=0, max_backoff=0)
+            raise
+        policy = job_policy(job)
+
+        print(task.job, job, task.args, task.kwargs)
+        if policy.timeout:
+            run_with_timeout(task.job, task.args, task.kwargs, policy.timeout)
+        else:
+            job(*task.args, **task.kwargs)
+    except TaskFailed as e:
+        error = str(e)
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        renewer.stop()
+
+    finished = timezone.now()
+    task.history = task.history + [{
+        'attempt': task.attempts,
+        'worker': worker,
+        'started': started.isoformat(),
+        'finished': finished.isoformat(),
+        'error': error,
+    }]
+    task.error = error
+    if error is None:
+        task.completed = finished
+    elif task.attempts <= policy.retries:
+        delay = policy.retry_delay(task.attempts)
+        print(f"Task {task.pk} ({task.job}) failed on attempt {task.attempts}, retrying in {delay:.0f}s:\n{error}")
+        task.started = None
+        task.worker = None
+        task.lease_expires = None
+        task.scheduled_time = finished + timedelta(seconds=delay)
+    else:
+        print(f"Task {task.pk} ({task.job}) failed on all {task.attempts} attempts:\n{error}")
+        task.completed = finished
+        task.dead = finished
+    task.save(update_fields=['attempts', 'history', 'error', 'completed', 'dead', 'started', 'worker',
+                             'lease_expires', 'scheduled_time'])
+
+
+def parse_queues(spec):
+    """Parse 'cache:3,links' into {'cache': 3, 'links': 1}"""
+    queues = {}
+    for item in spec.split(','):
+        name, _, weight = item.strip().partition(':')
+        if not name:
+            continue
+        try:
+            queues[name] = int(weight or 1)
+        except ValueError:
+            raise ValueError(f"Invalid weight for queue {name}: {weight}")
+        if queues[name] < 1:
+            raise ValueError(f"Weight for queue {name} must be at least 1")
+    return queues
+
+
+def queue_order(queues):
+    """The queues in a random order, each coming first in proportion to its weight"""
+    remaining = dict(queues)
+    order = []
+    while remaining:
+        name = random.choices(list(remaining), weights=list(remaining.values()))[0]
+        order.append(name)
+        del remaining[name]
+    return order
+
+
+def claim_next_task(worker, queues):
+    if queues is None:
+        return claim_task(worker)
+    # Try the queues in weighted order, so a busy queue can't starve the others but gets its share of the workers
+    for name in queue_order(queues):
+        task = claim_task(worker, [name])
+        if task is not None:
+            return task
+    return None
+
+
+def run_worker(stop, max_tasks=None, queues=None):
+    """Run tasks from queues ({name: weight}, or None for every queue) until stop is set, or max_tasks have been run"""
+    worker = worker_id()
+    print(f"Starting queue worker {worker}")
+    listener = TaskListener(worker)
+    tasks_run = 0
+    poll_interval = settings.TASK_POLL_INTERVAL
+    try:
+        while not stop.is_set() and (max_tasks is None or tasks_run < max_tasks):
+            close_old_connections()
+            task = claim_next_task(worker, queues)
+            if task is not None:
+                run_task(task, worker)
+                tasks_run += 1
+                poll_interval = settings.TASK_POLL_INTERVAL
+                continue
+
+            # Sleep until notified of a new task, the next scheduled task is due, or the poll interval passes
+            timeout = poll_interval
+            next_task = seconds_until_next_task(list(queues) if queues is not None else None)
+            if next_task is not None:
+                timeout = min(timeout, next_task)
+            notified = listener.wait(max(timeout, 0), stop)
+            if notified:
+                poll_interval = settings.TASK_POLL_INTERVAL
+            else:
+                poll_interval = min(poll_interval * 2, settings.TASK_POLL_MAX_INTERVAL)
+    finally:
+        listener.close()
+        connections.close_all()
+    print(f"Queue worker {worker} exiting after {tasks_run} tasks")
+
+
+def run_worker_process(stop, max_tasks, queues):
+    # The supervisor drains the pool on SIGTERM or SIGINT (which also reach the workers when sent to the process
+    # group), so the worker finishes its task rather than dying mid-task
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_worker(stop, max_tasks, queues)
+
+
+class WorkerPool:
+    """Runs concurrency workers, restarting any that crash or recycle, until SIGTERM or SIGINT drains the pool"""
+    def __init__(self, concurrency, processes=False, max_tasks=None, queues=None):
+        self.concurrency = concurrency
+        self.processes = processes
+        self.max_tasks = max_tasks
+        self.queues = queues
+        if processes:
+            self.context = multiprocessing.get_context('fork')
+            self.stop = self.context.Event()
+        else:
+            self.stop = threading.Event()
+        self.workers = [None] * concurrency
+        self.draining = False
+
+    def start_worker(self, slot):
+        args = (self.stop, self.max_tasks, self.queues)
+        if self.processes:
+            # Forked workers must open their own database connections rather than share the supervisor's
+            connections.close_all()
+            worker = self.context.Process(target=run_worker_process, args=args, name=f'queue-worker-{slot}')
+        else:
+            worker = threading.Thread(target=self.run_thread, args=args, name=f'queue-worker-{slot}')
+        worker.start()
+        self.workers[slot] = worker
+
+    @staticmethod
+    def run_thread(*args):
+        try:
+            run_worker(*args)
+        except Exception:
+            # The supervisor restarts the worker
+            traceback.print_exc()
+
+    def handle_signal(self, signum, frame):
+        # Only sets a flag, taking the stop event's lock here could deadlock with the supervisor loop
+        self.draining = True
+
+    def schedule(self):
+        """Queue the periodic jobs that are due, returning the seconds until the scheduler should check again"""
+        try:
+            next_due = schedule_periodic_jobs()
+        except Exception:
+            traceback.print_exc()
+            next_due = None
+        finally:
+            # Workers are forked from this process, so it mustn't hold a connection between checks
+            connections.close_all()
+        if next_due is None or next_due > settings.TASK_POLL_MAX_INTERVAL:
+            next_due = settings.TASK_POLL_MAX_INTERVAL
+        return next_due
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        for slot in range(self.concurrency):
+            self.start_worker(slot)
+
+        next_schedule = time.monotonic()
+        while not self.draining:
+            time.sleep(1)
+            if time.monotonic() >= next_schedule:
+                # Queued by the supervisor, so periodic jobs come due on time however busy the workers are
+                next_schedule = time.monotonic() + self.schedule()
+            for slot, worker in enumerate(self.workers):
+                if self.draining:
+                    break
+                if worker.is_alive():
+                    continue
+                if self.processes and worker.exitcode != 0:
+                    print(f"{worker.name} crashed with exit code {worker.exitcode}, restarting")
+                else:
+                    print(f"{worker.name} exited, restarting")
+                self.start_worker(slot)
+
+        print("Draining queue workers")
+        self.stop.set()
+        # Wake idle workers so they see they've been stopped
+        notify_workers()
+        for worker in self.workers:
+            worker.join()
+        print("Queue workers drained")
@@ -0,0 +1,799 @@
+"""
+Layered storage for the anonymous page cache.
+
+Lookups go through a byte-bounded LRU held in each worker's memory, then the
+shared ``pages`` cache backend, and finally the PageCache table. A hit in a
+lower tier is promoted into the tiers above it.
+
+Workers can't clear each other's memory tier directly, so every invalidation
+writes a new generation token to the shared store. Each worker compares its
+token on lookup and drops its memory tier when the token has moved on.
+"""
+import fnmatch
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from queue import Empty, SimpleQueue
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, transaction
+from django.db.models import Case, Count, ExpressionWrapper, F, FloatField, Q, Value, When
+from django.utils import timezone
+
+try:
+    import brotli
+
+    has_brotli = True
+except ImportError:
+    has_brotli = False
+
+GENERATION_KEY = 'page-cache-generation'
+# Set in the WSGI environ of internal renders, which can't be forged through an HTTP header
+REFRESH_ENVIRON_KEY = 'main.page_cache.refresh'
+TIERS = ('memory', 'shared', 'database')
+# Cloudflare ignores Cache-Tag headers longer than this
+CACHE_TAG_HEADER_LIMIT = 16 * 1024
+# Sent with every cached page, so invalidating every page only purges pages from the CDN, not static and media files
+PAGE_TAG = 'page'
+
+# The (model, pk) pairs loaded while rendering the current page, or None outside of a render
+_dependencies = ContextVar('page_cache_dependencies', default=None)
+
+
+@dataclass
+class CachedPage:
+    url: str
+    content: bytes
+    content_gzip: Optional[bytes] = None
+    content_br: Optional[bytes] = None
+    etag: str = ''
+    created: Optional[datetime] = None
+    stale_since: Optional[datetime] = None
+    cache_tags: str = ''
+
+    @property
+    def size(self) -> int:
+        return len(self.content) + len(self.content_gzip or b'') + len(self.content_br or b'')
+
+    @classmethod
+    def from_row(cls, row) -> 'CachedPage':
+        return cls(
+            url=row.url,
+            content=row.content.encode('utf-8'),
+            content_gzip=bytes(row.content_gzip) if row.content_gzip is not None else None,
+            content_br=bytes(row.content_br) if row.content_br is not None else None,
+            etag=row.etag,
+            created=row.created,
+            stale_since=row.stale_since,
+            cache_tags=row.cache_tags,
+        )
+
+    def body(self, encoding: Optional[str]) -> bytes:
+        if encoding == 'br':
+            return self.content_br
+        elif encoding == 'gzip':
+            return self.content_gzip
+        return self.content
+
+    @property
+    def age(self) -> int:
+        return int((timezone.now() - self.created).total_seconds()) if self.created is not None else 0
+
+    @property
+    def encodings(self) -> Tuple[str, ...]:
+        return tuple(encoding for encoding, body in (('br', self.content_br), ('gzip', self.content_gzip))
+                     if body is not None)
+
+
+def flag_param(name: str, value: str) -> Optional[str]:
+    """Parameters views only check the presence of, so every value renders the same page."""
+    return ''
+
+
+def page_param(name: str, value: str) -> Optional[str]:
+    if not value.isdigit() or not 1 <= int(value) <= settings.PAGE_CACHE_MAX_PAGE:
+        return None
+    return str(int(value))
+
+
+def date_param(name: str, value: str) -> Optional[str]:
+    if value == '':
+        return value
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date().isoformat()
+    except ValueError:
+        return None
+
+
+def tag_param(name: str, value: str) -> Optional[str]:
+    from .models import Tag
+    return '' if Tag.objects.filter(slug=name.partition('-')[2]).exists() else None
+
+
+def author_param(name: str, value: str) -> Optional[str]:
+    from .models import Author
+    # author=<name> filters by the value, author-<name>=... only checks the name is present
+    author_name, is_flag = (name.partition('-')[2], True) if '-' in name else (value, False)
+    if not Author.visible(False).filter(name=author_name).exists():
+        return None
+    return '' if is_flag else value
+
+
+def tour_param(name: str, value: str) -> Optional[str]:
+    from .models import Tour
+    if value == '' or Tour.objects.filter(slug=value).exists():
+        return value
+    return None
+
+
+# Checks each allowed query parameter, returning its canonical value for the cache key, or None when the value
+# can't be cached (so crawlers can't fill the cache with pages for made up values)
+QUERY_PARAM_VALIDATORS = {
+    'flag': flag_param,
+    'page': page_param,
+    'date': date_param,
+    'tag': tag_param,
+    'author': author_param,
+    'tour': tour_param,
+}
+
+
+def cache_key(path: str, query) -> Optional[str]:
+    """
+    The url a request for path with the query parameters in query is cached
+    under, or None if any of the parameters aren't cacheable for path.
+    """
+    if not query:
+        return path
+    allowed = next((params for pattern, params in settings.PAGE_CACHE_QUERY_PARAMS.items()
+                    if re.match(pattern, path)), None)
+    if allowed is None:
+        return None
+
+    params = {}
+    for name in query:
+        kind = next((kind for param, kind in allowed.items() if fnmatch.fnmatchcase(name, param)), None)
+        if kind is None:
+            return None
+        value = QUERY_PARAM_VALIDATORS[kind](name, query[name])  # The last value, which is the one views read
+        if value is None:
+            return None
+        if value != settings.PAGE_CACHE_QUERY_DEFAULTS.get(name):
+            params[name] = value
+    return path + ('?' + urlencode(sorted(params.items())) if params else '')
+
+
+def url_section(url: str) -> str:
+    """The first segment of a url's path, which PageCache indexes to narrow prefix matches."""
+    return url.lstrip('/').partition('/')[0].partition('?')[0]
+
+
+def collapse_prefixes(prefixes: Iterable[str]) -> List[str]:
+    """Drop every prefix already covered by a shorter one in prefixes."""
+    collapsed = []
+    for prefix in sorted(set(prefixes)):
+        # Sorting puts a prefix directly before everything it covers
+        if not collapsed or not prefix.startswith(collapsed[-1]):
+            collapsed.append(prefix)
+    return collapsed
+
+
+def prefix_filter(prefix: str) -> Q:
+    """Match cached urls starting with prefix, using the indexed section column where possible."""
+    section, slash, _ = prefix.lstrip('/').partition('/')
+    if slash:
+        in_section = Q(section=section)
+    elif section:
+        # The first segment may continue, so match every section beginning with it
+        in_section = Q(section__gte=section, section__lt=section + '\uffff')
+    else:
+        return Q(url__startswith=prefix)
+    # Pages stored before the section column existed have no section
+    return (in_section | Q(section=None)) & Q(url__startswith=prefix)
+
+
+def is_expired(stale_since: Optional[datetime]) -> bool:
+    """Whether a page marked stale at stale_since is too old to serve while it is revalidated."""
+    return stale_since is not None and \
+        timezone.now() - stale_since > timedelta(seconds=settings.PAGE_CACHE_MAX_STALENESS)
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def compress(content: bytes) -> Tuple[bytes, Optional[bytes]]:
+    """Return the gzip and brotli encodings of content, done once when a page is stored."""
+    # A fixed mtime keeps the gzip output identical for identical pages
+    content_gzip = gzip.compress(content, compresslevel=9, mtime=0)
+    # Quality 11 is ~10% smaller but ~20x slower, and this runs on every miss while waiters hold for the render lock
+    content_br = brotli.compress(content, mode=brotli.MODE_TEXT, quality=9) if has_brotli else None
+    return content_gzip, content_br
+
+
+def negotiate_encoding(accept_encoding: str, available: Tuple[str, ...]) -> Optional[str]:
+    """Pick the stored encoding the client prefers, or None for the identity body."""
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in available:  # Ordered by preference when qualities tie
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class ByteLRU:
+    """Least-recently-used mapping bounded by the total size of its values."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.evictions = 0
+        self.generation = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size: int):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+
+memory_cache = ByteLRU(settings.PAGE_CACHE_MEMORY_BYTES)
+
+_counters = {tier: {'hits': 0, 'misses': 0} for tier in TIERS}
+_counters_lock = threading.Lock()
+
+# Per-url counts since the last flush to PageCacheStats
+PATH_STAT_FIELDS = ('hits', 'misses', 'renders', 'render_time', 'invalidations', 'age_at_invalidation')
+_path_stats = {}
+_path_stats_lock = threading.Lock()
+_last_path_stats_flush = time.monotonic()
+# Urls written per query when flushing stats
+PATH_STATS_BATCH_SIZE = 200
+
+
+def shared_cache():
+    return caches[settings.PAGE_CACHE_SHARED_ALIAS]
+
+
+def shared_key(url: str) -> str:
+    # Hash the url so that long or unusual paths are always valid cache keys
+    return 'page:' + hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def record(tier: str, hit: bool):
+    with _counters_lock:
+        _counters[tier]['hits' if hit else 'misses'] += 1
+
+
+def tier_stats() -> dict:
+    with _counters_lock:
+        stats = {tier: dict(counts) for tier, counts in _counters.items()}
+    stats['memory'].update({
+        'entries': len(memory_cache),
+        'bytes': memory_cache.total_bytes,
+        'max_bytes': memory_cache.max_bytes,
+        'evictions': memory_cache.evictions,
+    })
+    return stats
+
+
+def record_path(url: str, size: Optional[int] = None, **counts):
+    """Add counts to the in-memory stats for url, flushing them to the database in the background when due."""
+    global _last_path_stats_flush
+
+    with _path_stats_lock:
+        stats = _path_stats.setdefault(url, dict.fromkeys(PATH_STAT_FIELDS, 0))
+        for name, value in counts.items():
+            stats[name] += value
+        if size is not None:
+            stats['size'] = size
+        flush_due = time.monotonic() - _last_path_stats_flush >= settings.PAGE_CACHE_STATS_FLUSH_INTERVAL
+        if flush_due:
+            _last_path_stats_flush = time.monotonic()
+    if flush_due:
+        threading.Thread(target=_flush_path_stats_in_background, daemon=True).start()
+
+
+def flush_path_stats():
+    from .models import PageCache, PageCacheStats
+
+    with _path_stats_lock:
+        pending = _path_stats.copy()
+        _path_stats.clear()
+
+    urls = list(pending)
+    for start in range(0, len(urls), PATH_STATS_BATCH_SIZE):
+        batch = urls[start:start + PATH_STATS_BATCH_SIZE]
+        now = timezone.now()
+        PageCacheStats.objects.bulk_create([PageCacheStats(url=url) for url in batch], ignore_conflicts=True)
+        # One update for the whole batch, adding each url's counts with a CASE on the url
+        updates = {}
+        for name in PATH_STAT_FIELDS + ('size',):
+            whens = [When(url=url, then=Value(pending[url][name])) for url in batch
+                     if pending[url].get(name)]
+            if not whens:
+                continue
+            field = PageCacheStats._meta.get_field(name)
+            if name == 'size':
+                updates[name] = Case(*whens, default=F(name), output_field=field)
+            else:
+                updates[name] = F(name) + Case(*whens, default=Value(0), output_field=field)
+        PageCacheStats.objects.filter(url__in=batch).update(updated=now, **updates)
+
+        hits = [When(url=url, then=Value(pending[url]['hits'])) for url in batch if pending[url]['hits']]
+        if hits:
+            # Used to pick pages to evict
+            PageCache.objects.filter(url__in=[url for url in batch if pending[url]['hits']]).update(
+                hits=F('hits') + Case(*hits, default=Value(0), output_field=PageCache._meta.get_field('hits')),
+                last_hit=now,
+            )
+
+
+def _flush_path_stats_in_background():
+    try:
+        flush_path_stats()
+    except Exception as e:
+        print(f'Failed to flush page cache stats: {e}')
+    finally:
+        connections.close_all()
+
+
+PATH_STAT_ORDERS = {
+    'render_time': '-render_time',
+    'misses': '-misses',
+    'invalidations': '-invalidations',
+    'size': '-size',
+    'hit_ratio': 'ordering_hit_ratio',
+}
+
+
+def worst_paths(order: str = 'render_time', limit: int = 100):
+    """The PageCacheStats costing the most by order, one of PATH_STAT_ORDERS."""
+    from .models import PageCacheStats
+
+    return PageCacheStats.objects.filter(Q(hits__gt=0) | Q(misses__gt=0) | Q(invalidations__gt=0)).annotate(
+        ordering_hit_ratio=ExpressionWrapper(F('hits') * 1.0 / (F('hits') + F('misses') + 1e-9), output_field=FloatField()),
+    ).order_by(PATH_STAT_ORDERS[order], 'url')[:limit]
+
+
+def sync_generation():
+    generation = shared_cache().get(GENERATION_KEY)
+    if generation != memory_cache.generation:
+        memory_cache.clear()
+        memory_cache.generation = generation
+
+
+UNCHECKED = object()
+
+
+def promote(page: CachedPage, shared: bool = True, generation=UNCHECKED):
+    """
+    Copy page into the memory tier, and the shared tier if shared. When given
+    the generation read before page was loaded, a page invalidated since then
+    isn't promoted.
+    """
+    if generation is not UNCHECKED and shared_cache().get(GENERATION_KEY) != generation:
+        return
+    if shared:
+        # The timeout bounds how long a page promoted just as it was invalidated can outlive the invalidation
+        shared_cache().set(shared_key(page.url), page, timeout=settings.PAGE_CACHE_SHARED_TIMEOUT)
+    memory_cache.set(page.url, page, page.size)
+
+
+def _get_from_upper_tiers(url: str, count: bool = True) -> Optional[CachedPage]:
+    sync_generation()
+
+    page = memory_cache.get(url)
+    if count:
+        record('memory', page is not None)
+    if page is not None:
+        return page
+
+    page = shared_cache().get(shared_key(url))
+    if count:
+        record('shared', page is not None)
+    if page is not None:
+        promote(page, shared=False)
+    return page
+
+
+def get_validators(url: str) -> Optional[Tuple[str, datetime, Optional[datetime]]]:
+    """
+    Return the (etag, created, stale_since) of a cached url without loading
+    its body from the database, or None if the url isn't cached.
+    """
+    from .models import PageCache
+
+    page = _get_from_upper_tiers(url, count=False)
+    if page is not None:
+        return page.etag, page.created, page.stale_since
+    return PageCache.objects.filter(url=url).values_list('etag', 'created', 'stale_since').first()
+
+
+def get_page(url: str) -> Optional[CachedPage]:
+    """Return the cached page for url from the fastest tier holding it."""
+    from .models import PageCache
+
+    page = _get_from_upper_tiers(url)
+    if page is not None:
+        return page
+
+    # Read before the row, so a discard() racing with this lookup stops the old row being promoted after it
+    generation = shared_cache().get(GENERATION_KEY)
+    row = PageCache.objects.filter(url=url).first()
+    record('database', row is not None)
+    if row is None:
+        return None
+
+    page = CachedPage.from_row(row)
+    # Expired pages are re-rendered rather than served, so mustn't reach the tiers other requests read from
+    if not is_expired(page.stale_since):
+        promote(page, generation=generation)
+    return page
+
+
+@contextmanager
+def track_dependencies():
+    """Collect the invalidatable model instances loaded inside the block into the yielded set."""
+    dependencies = set()
+    token = _dependencies.set(dependencies)
+    try:
+        yield dependencies
+    finally:
+        _dependencies.reset(token)
+
+
+def record_dependency(instance):
+    dependencies = _dependencies.get()
+    if dependencies is not None and instance.pk is not None and hasattr(instance, 'get_caches_to_invalidate'):
+        dependencies.add((type(instance), str(instance.pk)))
+
+
+def model_tag(model) -> str:
+    return model._meta.label_lower
+
+
+def instance_tag(model, pk) -> str:
+    return f'{model._meta.label_lower}:{pk}'
+
+
+def cache_tags(dependencies: Iterable[Tuple[type, str]]) -> str:
+    """
+    The Cache-Tag header for a page built from dependencies: PAGE_TAG, a tag
+    for each model, then for each instance until the header is as long as
+    allowed.
+    """
+    dependencies = list(dependencies)
+    tags = [PAGE_TAG] + sorted({model_tag(model) for model, _ in dependencies})
+    tags += sorted(instance_tag(model, pk) for model, pk in dependencies if not re.search(r'[\s,]', pk))
+    header = ''
+    for tag in tags:
+        extended = f'{header},{tag}' if header else tag
+        if len(extended) > CACHE_TAG_HEADER_LIMIT:
+            break
+        header = extended
+    return header
+
+
+def tagged_urls(tags: Iterable[str]) -> List[str]:
+    """
+    The cached urls built from an instance (app_label.model:pk) or any
+    instance of a model (app_label.model) in tags.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from .models import PageCache
+
+    condition = Q()
+    for tag in tags:
+        label, _, pk = tag.partition(':')
+        app_label, _, model_name = label.partition('.')
+        try:
+            content_type = ContentType.objects.get_by_natural_key(app_label, model_name)
+        except ContentType.DoesNotExist:
+            continue
+        if pk:
+            condition |= Q(dependencies__content_type=content_type, dependencies__object_id=pk)
+        else:
+            condition |= Q(dependencies__content_type=content_type)
+    if not condition:
+        return []
+    return list(PageCache.objects.filter(condition).values_list('url', flat=True).distinct())
+
+
+def dependent_urls(instance) -> List[str]:
+    """The cached urls that loaded instance while they were rendered."""
+    from django.contrib.contenttypes.models import ContentType
+    from .models import PageCache
+
+    return list(PageCache.objects.filter(
+        dependencies__content_type=ContentType.objects.get_for_model(instance),
+        dependencies__object_id=str(instance.pk),
+    ).values_list('url', flat=True).distinct())
+
+
+def untracked_urls() -> List[str]:
+    """The cached urls with no recorded dependencies, such as pages stored before tracking existed."""
+    from .models import PageCache
+
+    return list(PageCache.objects.filter(dependencies=None).values_list('url', flat=True))
+
+
+def store_page(url: str, content: bytes, dependencies: Iterable[Tuple[type, str]] = ()) -> CachedPage:
+    from django.contrib.contenttypes.models import ContentType
+    from .models import PageCache, PageDependency
+
+    content_gzip, content_br = compress(content)
+    dependencies = list(dependencies)
+    with transaction.atomic():
+        row, _ = PageCache.objects.update_or_create(url=url, defaults={
+            'section': url_section(url),
+            'content': content.decode('utf-8'),
+            'content_gzip': content_gzip,
+            'content_br': content_br,
+            'etag': content_hash(content),
+            'created': timezone.now(),
+            'stale_since': None,
+            'size': len(content) + len(content_gzip) + len(content_br or b''),
+            'cache_tags': cache_tags(dependencies),
+        })
+        PageDependency.objects.filter(page=row).delete()
+        PageDependency.objects.bulk_create([
+            PageDependency(page=row, content_type=ContentType.objects.get_for_model(model), object_id=pk)
+            for model, pk in dependencies
+        ])
+    page = CachedPage.from_row(row)
+    promote(page)
+    if settings.PAGE_CACHE_EXPORT:
+        export_page(page)
+    return page
+
+
+def export_path(url: str) -> Optional[Path]:
+    """The file under CACHE_ROOT mirroring url, or None if url can't be safely mapped to one."""
+    if '?' in url:
+        return None  # The front end looks files up by path alone
+    segments = url.strip('/').split('/') if url.strip('/') else []
+    if any(segment in ('', '.', '..') or '\\' in segment or '\0' in segment for segment in segments):
+        return None
+    root = Path(settings.CACHE_ROOT)
+    if not segments:
+        return root / 'index.html'
+    if url.endswith('/'):
+        return root.joinpath(*segments, 'index.html')
+    return root.joinpath(*segments[:-1], segments[-1] + '.html')
+
+
+def _write_atomic(path: Path, content: bytes):
+    # Write next to the target and rename over it, so the front end never serves a partial file
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(content)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def export_page(page: CachedPage):
+    path = export_path(page.url)
+    if path is None:
+        return
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _write_atomic(path, page.content)
+        for encoding, suffix in (('gzip', '.gz'), ('br', '.br')):
+            if encoding in page.encodings:
+                _write_atomic(path.with_name(path.name + suffix), page.body(encoding))
+    except OSError as e:
+        print(f'Failed to export {page.url} to {path}: {e}')
+
+
+def unexport(urls: Iterable[str]):
+    for url in urls:
+        path = export_path(url)
+        if path is None:
+            continue
+        for suffix in ('', '.gz', '.br'):
+            try:
+                path.with_name(path.name + suffix).unlink()
+            except FileNotFoundError:
+                pass
+
+
+def unexport_all():
+    shutil.rmtree(settings.CACHE_ROOT, ignore_errors=True)
+
+
+def render_lock_key(url: str) -> str:
+    return 'render-lock:' + hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def acquire_render_lock(url: str) -> bool:
+    """Claim the right to render url, shared between every thread and process using the shared tier."""
+    return shared_cache().add(render_lock_key(url), True, timeout=settings.PAGE_CACHE_RENDER_LOCK_TIMEOUT)
+
+
+def release_render_lock(url: str):
+    shared_cache().delete(render_lock_key(url))
+
+
+def wait_for_page(url: str) -> Optional[CachedPage]:
+    """
+    Wait for whoever holds the render lock for url to store it. Returns None
+    if the lock is released without a page, or the wait times out.
+    """
+    deadline = time.monotonic() + settings.PAGE_CACHE_SINGLE_FLIGHT_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        page = shared_cache().get(shared_key(url))
+        # A stale page is the one being re-rendered, not its result
+        if page is not None and page.stale_since is None:
+            memory_cache.set(url, page, page.size)
+            return page
+        if shared_cache().get(render_lock_key(url)) is None:
+            return None
+    return None
+
+
+def request_refresh(url: str):
+    """Queue a single background re-render of a stale url."""
+    from job_queue.utils import add_task
+
+    if shared_cache().add('refresh:' + shared_key(url), True, timeout=settings.PAGE_CACHE_RENDER_LOCK_TIMEOUT):
+        add_task(refresh_page, url, queue='cache', priority=5)
+
+
+def refresh_page(url: str):
+    render_paths([url], 1)
+    shared_cache().delete('refresh:' + shared_key(url))
+
+
+def bump_generation():
+    shared_cache().set(GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def discard(urls: Iterable[str]):
+    """Remove urls from the memory and shared tiers of every worker, and from the exported files."""
+    urls = list(urls)
+    shared_cache().delete_many([shared_key(url) for url in urls])
+    bump_generation()
+    unexport(urls)
+
+
+def discard_all():
+    shared_cache().clear()
+    bump_generation()
+    unexport_all()
+
+
+def sitemap_paths() -> List[str]:
+    from .sitemaps import sitemaps
+
+    paths = []
+    for sitemap_class in sitemaps.values():
+        sitemap = sitemap_class()
+        paths += [sitemap.location(item) for item in sitemap.items()]
+    return paths
+
+
+def prioritise_paths(paths: Iterable[str]) -> List[str]:
+    """Deduplicate paths and order them from most to least viewed."""
+    from analytics.models import Page as ViewedPage
+
+    paths = set(paths)
+    views = dict(ViewedPage.objects.filter(path__in=paths)
+                 .annotate(views=Count('pageview'))
+                 .values_list('path', 'views'))
+    return sorted(paths, key=lambda path: (-views.get(path, 0), path))
+
+
+def render_paths(paths: List[str], workers: int):
+    """
+    Render each path anonymously through the full middleware stack and store
+    the result, replacing any cached copy.
+    """
+    from django.test import Client
+
+    pending = SimpleQueue()
+    for path in paths:
+        pending.put(path)
+
+    def worker():
+        client = Client(HTTP_HOST=settings.PAGE_CACHE_WARM_HOST, raise_request_exception=False)
+        try:
+            while True:
+                try:
+                    path = pending.get_nowait()
+                except Empty:
+                    return
+                response = client.get(path, secure=True, **{REFRESH_ENVIRON_KEY: True})
+                print(f'Warmed {path}: {response.status_code} {response.get("DB-cache-status")}')
+        finally:
+            # Each thread has its own database connections
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(worker) for _ in range(min(workers, len(paths)))]
+    for future in futures:
+        future.result()  # Re-raise anything that stopped a worker early
+
+
+def warm_page_cache(urls: Iterable[str] = (), include_sitemaps: bool = True):
+    """
+    Re-render urls, plus every url in the sitemaps if include_sitemaps, so
+    that visitors after an invalidation don't pay the render cost.
+    """
+    from .middleware import is_bypassed
+
+    if settings.NOCACHE:
+        return
+
+    paths = [url for url in urls if not is_bypassed(url)]
+    if include_sitemaps:
+        paths += sitemap_paths()
+    paths = prioritise_paths(paths)[:settings.PAGE_CACHE_WARM_LIMIT]
+
+    print(f'Warming {len(paths)} pages')
+    render_paths(paths, settings.PAGE_CACHE_WARM_WORKERS)
@@ -0,0 +1,124 @@
+"""
+Client for Cloudflare's cache purge API.
+
+A single session is kept per process so connections are reused between
+purges. Chunks of urls or Cache-Tags are purged concurrently, and rate
+limited (429) or failed (5xx) requests are retried with exponential backoff,
+waiting for at least as long as the API's Retry-After header asks.
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+# Cloudflare will only purge 30 files or tags at a time, use 29 for off-by-one safety
+ITEMS_PER_REQUEST = 29
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_BACKOFF = 60
+
+
+class CloudflarePurgeClient:
+    def __init__(self, zone_id: str, token: str, domain: str, api_base: str = 'https://api.cloudflare.com/client/v4',
+                 concurrency: int = 4, max_retries: int = 5, backoff: float = 1, timeout: float = 30):
+        self.purge_url = f'{api_base.rstrip("/")}/zones/{zone_id}/purge_cache'
+        self.domain = domain
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=concurrency))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=concurrency))
+        self.session.headers.update({
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+        })
+
+    def file_url(self, path: str) -> str:
+        return f'https://{self.domain}{path}'
+
+    def purge_paths(self, paths: Iterable[str]) -> List[str]:
+        """Purge paths from Cloudflare's cache, returning the paths that couldn't be purged."""
+        return self.purge_in_chunks(paths, lambda chunk: {'files': [self.file_url(path) for path in chunk]})
+
+    def purge_tags(self, tags: Iterable[str]) -> List[str]:
+        """Purge every response with one of the Cache-Tags in tags, returning the tags that couldn't be purged."""
+        return self.purge_in_chunks(tags, lambda chunk: {'tags': chunk})
+
+    def purge_everything(self) -> bool:
+        return self.purge({'purge_everything': True}, 'everything')
+
+    def purge_in_chunks(self, items: Iterable[str], build_data) -> List[str]:
+        items = list(dict.fromkeys(items))
+        chunks = [items[i:i + ITEMS_PER_REQUEST] for i in range(0, len(items), ITEMS_PER_REQUEST)]
+        if not chunks:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(chunks))) as executor:
+            results = list(executor.map(lambda chunk: self.purge(build_data(chunk), chunk), chunks))
+        return [item for chunk, purged in zip(chunks, results) if not purged for item in chunk]
+
+    def purge(self, data: dict, description) -> bool:
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                response = self.session.post(self.purge_url, json=data, timeout=self.timeout)
+            except requests.RequestException as e:
+                print(f'Cloudflare purge of {description} failed: {e}')
+            else:
+                if response.status_code == 200 and self.succeeded(response):
+                    print(f'Purged {description} from Cloudflare')
+                    return True
+                print(f'Cloudflare purge of {description} failed with status {response.status_code}: '
+                      f'{response.text[:500]}')
+                if response.status_code not in RETRY_STATUSES:
+                    return False
+                retry_after = self.retry_after(response)
+                if retry_after is not None and retry_after > MAX_BACKOFF:
+                    return False  # Left for the retry queue rather than blocking for that long
+
+            if attempt < self.max_retries:
+                delay = min(self.backoff * 2 ** attempt, MAX_BACKOFF) * random.uniform(0.5, 1)
+                time.sleep(max(delay, retry_after or 0))
+        return False
+
+    @staticmethod
+    def succeeded(response) -> bool:
+        try:
+            return response.json().get('success', False)
+        except ValueError:
+            return False
+
+    @staticmethod
+    def retry_after(response) -> Optional[float]:
+        try:
+            return float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            return None
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> CloudflarePurgeClient:
+    """The purge client for this process, built from settings."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = CloudflarePurgeClient(
+                settings.CLOUDFLARE_ZONE_ID,
+                settings.CLOUDFLARE_API_TOKEN,
+                settings.CLOUDFLARE_DOMAIN,
+                api_base=settings.CLOUDFLARE_API_BASE,
+                concurrency=settings.CLOUDFLARE_PURGE_CONCURRENCY,
+                max_retries=settings.CLOUDFLARE_PURGE_RETRIES,
+            )
+        return _client
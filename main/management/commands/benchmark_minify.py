@@ -0,0 +1,70 @@
+import timeit
+
+from bs4 import BeautifulSoup
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+
+from main.cache import REFRESH_ENVIRON_KEY
+from main.minify import minify_html
+from main.models import DraftHistory, Tour
+
+
+def soup_round_trip(html):
+    # The BeautifulSoup round-trip previously used when storing pages
+    return str(BeautifulSoup(html, 'html.parser'))
+
+
+class Command(BaseCommand):
+    help = "Compare the page cache's minifier against the previous BeautifulSoup round-trip on rendered pages"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--path',
+                            dest='paths',
+                            action='append',
+                            default=[],
+                            help='Path to render and minify, defaults to the front page and a tour page')
+        parser.add_argument('-f', '--file',
+                            dest='files',
+                            action='append',
+                            default=[],
+                            help='Saved HTML file to minify instead of rendering a path')
+        parser.add_argument('-n', '--number',
+                            type=int,
+                            default=20,
+                            help='Number of times to minify each page')
+
+    def handle(self, *args, **options):
+        pages = []
+        for file_path in options['files']:
+            with open(file_path, 'rb') as file:
+                pages.append((file_path, file.read()))
+
+        paths = options['paths']
+        if not paths and not pages:
+            paths = [reverse('front-page')]
+            tour = Tour.objects.filter(DraftHistory.published_q).first()
+            if tour is not None:
+                paths.append(reverse('tour', args=[tour.slug]))
+
+        client = Client(HTTP_HOST=settings.PAGE_CACHE_WARM_HOST)
+        for path in paths:
+            # Render fresh rather than getting the already minified copy from the page cache
+            response = client.get(path, secure=True, **{REFRESH_ENVIRON_KEY: True})
+            if response.status_code != 200:
+                raise CommandError(f'{path} returned {response.status_code}')
+            pages.append((path, response.content))
+
+        number = options['number']
+        for name, html in pages:
+            soup_time = timeit.timeit(lambda: soup_round_trip(html), number=number) / number
+            minify_time = timeit.timeit(lambda: minify_html(html), number=number) / number
+            soup_size = len(soup_round_trip(html).encode('utf-8'))
+            minified_size = len(minify_html(html))
+            self.stdout.write(
+                f'{name}: {len(html)} bytes\n'
+                f'  BeautifulSoup: {soup_time * 1000:.2f}ms, {soup_size} bytes\n'
+                f'  minify_html:   {minify_time * 1000:.2f}ms, {minified_size} bytes '
+                f'({soup_time / minify_time:.1f}x faster)'
+            )
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from main.signals import queue_sync_all
+
+
+class Command(BaseCommand):
+    help = "Queue a vectordb sync of every article, page, tour and destination detail"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch-size',
+                            type=int,
+                            default=500,
+                            help='Number of tasks to insert at once')
+
+    def handle(self, *args, **options):
+        count = queue_sync_all(batch_size=options['batch_size'])
+        self.stdout.write(f'Queued {count} vectordb syncs')
@@ -1,64 +1,172 @@
 import re
-from bs4 import BeautifulSoup
+import time
 from typing import Any, Dict
 
 from django.conf import settings
 from django.http import HttpResponse, HttpRequest
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
 
-from main.models import PageCache
+from main import cache as page_cache
+from main.minify import minify_html
+from main.models import collect_invalidations
 
 
-def minify_html(html):
-    soup = BeautifulSoup(html, 'html.parser')
-    return str(soup)
+BYPASS_URLS = [
+    r'^/admin/',
+    r'^/static/',
+    r'^/media/',
+    r'^/stats/',
+    r'^/testimonials/',
+    r'^/customers/',
+    r'^/sitemap\.xml',
+    r'^/robots\.txt',
+    r'^/messages',
+    r'^/account/',
+]
 
 
-class CacheForUsers:
+def is_bypassed(path):
+    return any(re.match(ignored_path, path) for ignored_path in BYPASS_URLS)
+
+
+class CollectInvalidations:
+    """
+    Queue the page cache invalidations from a request's saves as one, before the response is returned so the
+    request's database connection is still open and a failure to queue them isn't lost
+    """
     def __init__(self, get_response):
         self.get_response = get_response
 
     def __call__(self, request):
-        bypass_urls = [
-            r'^/admin/',
-            r'^/static/',
-            r'^/media/',
-            r'^/stats/',
-            r'^/testimonials/',
-            r'^/customers/',
-            r'^/sitemap\.xml',
-            r'^/robots\.txt',
-            r'^/messages',
-            r'^/account/',
-        ]
+        with collect_invalidations():
+            return self.get_response(request)
 
+
+class CacheForUsers:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
         path = request.path
+        # Requests with query parameters are only cached when every parameter is allowed for the path
+        key = page_cache.cache_key(path, request.GET)
 
         is_get = request.method == 'GET'
-        has_no_query_params = len(request.GET) == 0
+        is_cacheable_query = key is not None
         is_anonymous = not request.user.is_authenticated
-        not_bypassed_url = not any(re.match(ignored_path, path) for ignored_path in bypass_urls)
+        not_bypassed_url = not is_bypassed(path)
+
+        if is_get and is_anonymous and is_cacheable_query and not_bypassed_url and not settings.NOCACHE:
+            # Internal re-renders skip the lookup so that they replace whatever is cached
+            is_refresh = request.META.get(page_cache.REFRESH_ENVIRON_KEY, False)
+            page = None
+            status = 'HIT'
+            if not is_refresh:
+                # Answer conditional requests from the stored validators before loading any body
+                not_modified = self.not_modified_response(request, key)
+                if not_modified is not None:
+                    return not_modified
+
+                # Retrieve response from the page cache tiers if it exists, otherwise store response
+                page = page_cache.get_page(key)
 
-        if is_get and is_anonymous and has_no_query_params and not_bypassed_url and not settings.NOCACHE:
-            # Retrieve response from PageCache if it exists, otherwise store response
-            try:
+            if page is not None and page.stale_since is not None:
+                # Serve stale pages while a background task re-renders them, up to the maximum staleness
+                if page_cache.is_expired(page.stale_since):
+                    page = None
+                else:
+                    page_cache.request_refresh(key)
+                    status = 'STALE'
+
+            is_renderer = False
+            if page is None:
+                # Only one request renders a missing page, the rest wait for its result
+                is_renderer = page_cache.acquire_render_lock(key)
+                if not is_renderer and not is_refresh:
+                    page = page_cache.wait_for_page(key)
+                    status = 'HIT;waited'
+
+            if page is not None:
+                response = self.page_response(request, page)
+                response['DB-cache-status'] = status
+                page_cache.record_path(key, hits=1)
+            else:
                 try:
-                    cache = PageCache.objects.get(url=path)
-                    response = HttpResponse(cache.content)
-                except PageCache.MultipleObjectsReturned:
-                    cache = PageCache.objects.filter(url=path).first()
-                    response = HttpResponse(cache.content)
-                    # Delete duplicates other than the one we retrieved
-                    PageCache.objects.filter(url=path).exclude(id=cache.id).delete()
-                response['DB-cache-status'] = 'HIT'
-            except PageCache.DoesNotExist:
-                response = self.get_response(request)
-                if isinstance(response, HttpResponse) and response.status_code == 200 and response.get("Content-Type", "").startswith("text/html"):
-                    # Minify HTML response
-                    minified = minify_html(response.content)
-                    PageCache.objects.create(url=path, content=minified)
+                    # Record which model instances the page is built from, so saving one invalidates only this page
+                    render_start = time.perf_counter()
+                    with page_cache.track_dependencies() as dependencies:
+                        response = self.get_response(request)
+                    render_time = time.perf_counter() - render_start
+                    if isinstance(response, HttpResponse) and response.status_code == 200 and response.get("Content-Type", "").startswith("text/html"):
+                        # Minify HTML response
+                        minified = minify_html(response.content)
+                        page = page_cache.store_page(key, minified, dependencies)
+                        self.set_validators(response, page.etag, page.created)
+                        self.set_cache_tags(response, page)
+                        # Background re-renders count towards the render cost, but only visitors count as misses
+                        page_cache.record_path(key, size=page.size, misses=0 if is_refresh else 1, renders=1,
+                                               render_time=render_time)
+                finally:
+                    if is_renderer:
+                        page_cache.release_render_lock(key)
                 response['DB-cache-status'] = 'MISS'
         else:
             response = self.get_response(request)
-            response['DB-cache-status'] = 'NO-CACHE' + (';is-not-get' if not is_get else '') + (';has-query' if not has_no_query_params else '') + (';authed' if not is_anonymous else '') + (';bypassed-url' if not not_bypassed_url else '') + (';nocache-env' if settings.NOCACHE else '')
+            response['DB-cache-status'] = 'NO-CACHE' + (';is-not-get' if not is_get else '') + (';has-query' if not is_cacheable_query else '') + (';authed' if not is_anonymous else '') + (';bypassed-url' if not not_bypassed_url else '') + (';nocache-env' if settings.NOCACHE else '')
+
+        return response
+
+    def page_response(self, request, page):
+        encoding = page_cache.negotiate_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''), page.encodings)
+        body = page.body(encoding)
+        response = HttpResponse(body)
+        if encoding is not None:
+            # Already compressed, so GZipMiddleware will leave this response alone
+            response['Content-Encoding'] = encoding
+        response['Content-Length'] = str(len(body))
+        patch_vary_headers(response, ('Accept-Encoding',))
+        self.set_validators(response, page.etag, page.created)
+        self.set_cache_tags(response, page)
+        if page.stale_since is not None:
+            response['Age'] = str(page.age)
+        return response
+
+    @staticmethod
+    def set_validators(response, etag, created):
+        if etag:
+            # Weak, as the same etag covers the identity, gzip and brotli bodies
+            response['ETag'] = f'W/"{etag}"'
+        if created is not None:
+            response['Last-Modified'] = http_date(created.timestamp())
+
+    @staticmethod
+    def set_cache_tags(response, page):
+        # Lets the CDN purge this page by the models and instances it was built from
+        if page.cache_tags:
+            response['Cache-Tag'] = page.cache_tags
+
+    def not_modified_response(self, request, key):
+        if not any(header in request.META for header in ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE')):
+            return None
+
+        validators = page_cache.get_validators(key)
+        if validators is None:
+            return None
+        etag, created, stale_since = validators
+        if page_cache.is_expired(stale_since):
+            return None
 
+        response = get_conditional_response(
+            request,
+            etag=f'W/"{etag}"' if etag else None,
+            last_modified=int(created.timestamp()) if created is not None else None,
+        )
+        if response is not None:
+            self.set_validators(response, etag, created)
+            patch_vary_headers(response, ('Accept-Encoding',))
+            response['DB-cache-status'] = 'HIT;not-modified'
+            page_cache.record_path(key, hits=1)
+            if stale_since is not None:
+                page_cache.request_refresh(key)
         return response
@@ -0,0 +1,60 @@
+"""
+HTML minifier for cached pages.
+
+Works directly on the encoded bytes with a single regex tokenizer instead of
+parsing a DOM: comments are dropped, runs of whitespace in text and inside
+tags are collapsed, and the contents of <pre>, <textarea>, <script> and
+<style> are copied through untouched.
+"""
+import re
+from typing import Iterator
+
+RAW_ELEMENTS = (b'pre', b'textarea', b'script', b'style')
+
+_TOKEN = re.compile(rb'''
+    (?P<comment><!--(?!\[if).*?-->)
+  | (?P<raw><(?P<name>''' + b'|'.join(RAW_ELEMENTS) + rb''')(?=[\s/>])(?:"[^"]*"|'[^']*'|[^'">])*>(?:.*?</(?P=name)\s*>|.*\Z))
+  | (?P<tag></?[a-zA-Z!?](?:"[^"]*"|'[^']*'|[^'">])*>)
+  | (?P<space>\s+)
+''', re.IGNORECASE | re.DOTALL | re.VERBOSE)
+
+_TAG_SPACE = re.compile(rb'''("[^"]*"|'[^']*')|\s+''')
+
+
+def _collapse_tag_space(match):
+    return match.group(1) or b' '
+
+
+def _minify_tag(tag: bytes) -> bytes:
+    tag = _TAG_SPACE.sub(_collapse_tag_space, tag)
+    if tag.endswith(b' >'):
+        tag = tag[:-2] + b'>'
+    return tag
+
+
+def iter_minified(html: bytes) -> Iterator[bytes]:
+    """Yield the minified html in chunks, in a single pass over the input."""
+    position = 0
+    # Collapsed whitespace waiting for the next token, so whitespace either side of a dropped comment merges
+    pending_space = b''
+    for match in _TOKEN.finditer(html):
+        start = match.start()
+        if start > position:
+            yield pending_space + html[position:start]
+            pending_space = b''
+        position = match.end()
+
+        kind = match.lastgroup
+        if kind == 'space':
+            # Keep a line break where there was one, so pre-line styled text still wraps the same way
+            pending_space = b'\n' if b'\n' in match.group() or pending_space == b'\n' else b' '
+        elif kind != 'comment':
+            yield pending_space + (_minify_tag(match.group()) if kind == 'tag' else match.group())
+            pending_space = b''
+    yield pending_space + html[position:]
+
+
+def minify_html(html) -> bytes:
+    if isinstance(html, str):
+        html = html.encode('utf-8')
+    return b''.join(iter_minified(html))
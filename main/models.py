@@ -1,5 +1,7 @@
-import json
+import copy
 import re
+import threading
+from contextlib import contextmanager
 from datetime import timedelta
 from io import BytesIO
 from typing import Tuple, Optional
@@ -14,11 +16,13 @@ from ckeditor_uploader.fields import RichTextUploadingField
 from colorfield.fields import ColorField
 from django_countries.fields import CountryField
 
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.core.files import File
-from django.db import models
-from django.db.models import F, Q
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models import F, Q, Sum
+from django.db.models.fields.files import FieldFile
+from django.db.models.signals import post_init, post_save, pre_save
 from django.dispatch import receiver
 from django.templatetags.static import static
 from django.urls import reverse
@@ -31,6 +35,8 @@ from django.apps import apps
 
 from .images import crop_to_ar, autorotate
 import job_queue.utils as queue
+from . import cache as page_cache
+from . import cloudflare
 
 import openai
 import hashlib
@@ -150,6 +156,9 @@ class Region(DraftHistory):
     display_tours = models.BooleanField(default=True)
     display_guides = models.BooleanField(default=True)
 
+    # Fields that change which listings show the region, see changes_listings
+    listing_fields = ('slug', 'list_order', 'display_tours', 'display_guides', 'published_bool', 'published_date')
+
     def get_caches_to_invalidate(self, previous):
         return 'all'
 
@@ -187,6 +196,8 @@ class Destination(DraftHistory):
     guide_banner_x = models.FloatField(default=50)
     guide_banner_y = models.FloatField(default=50)
 
+    listing_fields = ('slug', 'region', 'published_bool', 'published_date')
+
     def get_caches_to_invalidate(self, previous):
         return 'all'
 
@@ -306,6 +317,8 @@ class DestinationDetails(DraftHistory):
             'published': self.published,
         }
 
+    listing_fields = ('slug', 'destination', 'order', 'type', 'published_bool', 'published_date')
+
     def get_caches_to_invalidate(self, previous):
         return 'all'
 
@@ -650,6 +663,8 @@ class Page(DraftHistory):
         # Return card_img.url without the media url
         return self.card_img.url[len(settings.MEDIA_URL):]
 
+    listing_fields = ('slug', 'parent', 'in_navbar', 'front_page_pos', 'published_bool', 'published_date')
+
     def get_caches_to_invalidate(self, previous):
         if self.in_navbar:
             return "all"
@@ -797,6 +812,9 @@ class Settings(models.Model):
 
     history = HistoricalRecords(excluded_fields=('active',))
 
+    # Every page loads the active settings while rendering
+    listing_fields = ('active',)
+
     def get_caches_to_invalidate(self, previous):
         return "all"
 
@@ -877,11 +895,11 @@ class PositionTemplate(models.Model):
     name = models.CharField(max_length=100, unique=True)
 
     def get_caches_to_invalidate(self, previous):
-        tours = Tour.objects.filter(stops__template=self).distinct()
-        tour_paths = [reverse("tour", args=[tour.slug]) for tour in tours]
-        regions = Region.objects.all()
-        region_paths = [reverse("tours", args=[region.slug]) for region in regions]
-        return tour_paths + region_paths + [reverse("front-page"), reverse("destinations")]
+        return []
+
+    def get_cache_tags_to_invalidate(self, previous):
+        # Every map and tour page showing this template loaded it while rendering
+        return [page_cache.instance_tag(PositionTemplate, self.pk)]
 
     def __str__(self):
         return self.name
@@ -933,8 +951,11 @@ class MapPoint(models.Model):
             raise ValidationError('Either both x and y must be set or template must be set')
 
     def get_caches_to_invalidate(self, previous):
-        region_tours = [reverse("tours", args=[region.slug]) for region in Region.objects.all()]
-        return [reverse("front-page"), reverse("destinations")] + region_tours
+        return []
+
+    def get_cache_tags_to_invalidate(self, previous):
+        # New points appear on every page showing the map, so invalidate every page that loaded any point
+        return [page_cache.model_tag(MapPoint)]
 
     def __str__(self):
         return self.name
@@ -1013,33 +1034,161 @@ class FileUpload(models.Model):
 
 
 class PageCache(models.Model):
-    url = models.URLField()
+    # The path, plus any allowed query parameters in canonical order
+    url = models.URLField(max_length=500)
+    # First segment of the url, so prefix invalidation can use an index
+    section = models.CharField(max_length=200, null=True, blank=True, db_index=True)
     content = models.TextField()
+    # Compressed once when the page is stored, so hits can be served without re-compressing
+    content_gzip = models.BinaryField(null=True, blank=True)
+    content_br = models.BinaryField(null=True, blank=True)
+    # Validators for conditional GETs, readable without loading the content
+    etag = models.CharField(max_length=64, blank=True, default='')
+    created = models.DateTimeField(default=timezone.now)
+    # Set instead of deleting the row when invalidating in stale-while-revalidate mode
+    stale_since = models.DateTimeField(null=True, blank=True)
+    # For eviction, size is the stored bytes across all encodings. Hits are added when stats are flushed
+    size = models.PositiveIntegerField(default=0)
+    hits = models.PositiveBigIntegerField(default=0)
+    last_hit = models.DateTimeField(null=True, blank=True)
+    # The Cache-Tag header sent with the page, the models and instances it was rendered from
+    cache_tags = models.TextField(blank=True, default='')
 
     class Meta:
+        constraints = [
+            UniqueConstraint(fields=['url'], name='url_idx'),
+        ]
+
+
+class PageDependency(models.Model):
+    # A model instance that was loaded while rendering a cached page. Deleted explicitly before its page, so that
+    # deleting PageCaches stays a single statement instead of loading every row to cascade
+    page = models.ForeignKey(PageCache, on_delete=models.DO_NOTHING, related_name='dependencies')
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.CharField(max_length=64)
+
+    class Meta:
+        verbose_name_plural = 'page dependencies'
         indexes = [
-            models.Index(fields=['url'], name='url_idx'),
+            models.Index(fields=['content_type', 'object_id'], name='page_dependency_idx'),
         ]
 
 
-def purge_cloudflare_page(path):
-    if not settings.PRODUCTION or settings.CLOUDFLARE_API_TOKEN is None:
+class PageCacheStats(models.Model):
+    # Running totals per cached url, flushed periodically from each worker's in-memory counts
+    url = models.URLField(max_length=500, unique=True)
+    hits = models.PositiveBigIntegerField(default=0)
+    misses = models.PositiveBigIntegerField(default=0)
+    renders = models.PositiveBigIntegerField(default=0)
+    render_time = models.FloatField(default=0)  # Total seconds spent rendering
+    invalidations = models.PositiveBigIntegerField(default=0)
+    age_at_invalidation = models.FloatField(default=0)  # Total seconds
+    size = models.PositiveIntegerField(default=0)  # Stored bytes, across all encodings
+    updated = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name_plural = 'page cache stats'
+
+    @property
+    def hit_ratio(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else None
+
+    @property
+    def average_render_time(self):
+        return self.render_time / self.renders if self.renders else None
+
+    @property
+    def average_age_at_invalidation(self):
+        return self.age_at_invalidation / self.invalidations if self.invalidations else None
+
+    def as_dict(self):
+        return {
+            'url': self.url,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hit_ratio,
+            'renders': self.renders,
+            'average_render_time': self.average_render_time,
+            'invalidations': self.invalidations,
+            'average_age_at_invalidation': self.average_age_at_invalidation,
+            'size': self.size,
+            'updated': self.updated,
+        }
+
+
+@receiver(post_init)
+def record_page_dependency(sender, instance, **kwargs):
+    page_cache.record_dependency(instance)
+    if hasattr(instance, 'get_caches_to_invalidate'):
+        take_snapshot(instance)
+
+
+def snapshot_value(value):
+    if isinstance(value, FieldFile):
+        return value.name
+    elif isinstance(value, (dict, list)):
+        return copy.deepcopy(value)
+    return value
+
+
+def take_snapshot(instance):
+    # Only trusted once the instance has been loaded or saved, see find_changed_fields
+    instance._snapshot = {field.attname: snapshot_value(instance.__dict__[field.attname])
+                          for field in instance._meta.concrete_fields if field.attname in instance.__dict__}
+
+
+def rendered_field_names(model):
+    """The fields that can change rendered pages, declared by rendered_fields or otherwise all but auto_now ones"""
+    rendered_fields = getattr(model, 'rendered_fields', None)
+    if rendered_fields is not None:
+        return set(rendered_fields)
+    return {field.name for field in model._meta.concrete_fields
+            if not getattr(field, 'auto_now', False) and not getattr(field, 'auto_now_add', False)}
+
+
+@receiver(pre_save)
+def find_changed_fields(sender, instance, update_fields=None, **kwargs):
+    """Set instance.changed_fields to the fields changed since it was loaded, or None if that isn't known"""
+    if not hasattr(instance, 'get_caches_to_invalidate'):
         return
-    print(f'Invalidating {path} on Cloudflare')
-    purge_url = f'https://api.cloudflare.com/client/v4/zones/{settings.CLOUDFLARE_ZONE_ID}/purge_cache'
-    headers = {
-        'Authorization': f'Bearer {settings.CLOUDFLARE_API_TOKEN}',
-        'Content-Type': 'application/json',
-        'Accept': 'application/json'
-    }
-    data = {
-        'files': [f'https://{settings.CLOUDFLARE_DOMAIN}{path}']
+    snapshot = getattr(instance, '_snapshot', None)
+    if instance._state.adding or snapshot is None:
+        instance.changed_fields = None
+        return
+
+    fields = [field for field in instance._meta.concrete_fields if field.attname in instance.__dict__]
+    if update_fields is not None:
+        fields = [field for field in fields if field.name in update_fields or field.attname in update_fields]
+    instance.changed_fields = {
+        field.name for field in fields
+        if field.attname not in snapshot or snapshot_value(instance.__dict__[field.attname]) != snapshot[field.attname]
     }
-    print(f'Purging {path} from Cloudflare using url: {purge_url}, headers: {headers}, data: {data}')
-    response = requests.post(purge_url, headers=headers, data=json.dumps(data))
-    print(f'Cloudflare response: {response.text}')
-    if response.status_code != 200:
-        raise Exception(f'Cloudflare purge of {path} failed with status code {response.status_code} and message {response.text}')
+
+
+def changes_listings(instance):
+    """
+    Whether saving instance can change pages that never loaded it, like a listing it joins or leaves. Models
+    invalidating 'all' declare the fields that can in listing_fields, without them every change is assumed to
+    """
+    listing_fields = getattr(instance, 'listing_fields', None)
+    changed_fields = getattr(instance, 'changed_fields', None)
+    if listing_fields is None or changed_fields is None:
+        return True
+    return bool(changed_fields & set(listing_fields))
+
+
+def previous_instance(instance):
+    """A copy of instance with the values it was loaded with, made without querying the database"""
+    previous = copy.copy(instance)
+    previous._state = copy.copy(instance._state)
+    previous._state.fields_cache = {}
+    previous.__dict__.update(instance._snapshot)
+    return previous
+
+
+def purge_cloudflare_page(path):
+    purge_cloudflare_pages([path])
 
 
 def chunked_list(lst, n):
@@ -1048,65 +1197,265 @@ def chunked_list(lst, n):
         yield lst[i:i + n]
 
 
-def purge_cloudflare_pages(paths):
+def should_purge_cloudflare():
     if settings.NO_CACHE_INVALIDATION:
+        return False
+    return settings.PRODUCTION and settings.CLOUDFLARE_API_TOKEN is not None
+
+
+def queue_cloudflare_purge(job, *args):
+    # Purged in their own tasks, so a slow or failing purge doesn't hold up or retry the local invalidation
+    if should_purge_cloudflare():
+        queue.add_task(job, *args, queue='cache', priority=10)
+
+
+def requeue_cloudflare_purge(job, failed, attempt, description):
+    if attempt < settings.CLOUDFLARE_PURGE_REQUEUES:
+        # Try the failed purge again later, without holding up the rest of the invalidation
+        print(f'Requeueing Cloudflare purge of {description}, attempt {attempt}')
+        queue.add_task(job, failed, attempt=attempt + 1, queue='cache', priority=10,
+                       scheduled_time=timezone.now() + timedelta(seconds=60 * attempt))
+    else:
+        print(f'Giving up on Cloudflare purge of {description} after {attempt} attempts')
+
+
+# Run in the worker rather than a time limited child, so they share the client's pooled session. The client's
+# request timeout and bounded retries already stop a purge hanging
+def purge_cloudflare_pages(paths, attempt=1):
+    if not should_purge_cloudflare():
         return
 
-    if not settings.PRODUCTION or settings.CLOUDFLARE_API_TOKEN is None:
+    failed = cloudflare.get_client().purge_paths(paths)
+    if failed:
+        requeue_cloudflare_purge(purge_cloudflare_pages, failed, attempt, f'{len(failed)} paths')
+
+
+def purge_cloudflare_tags(tags, attempt=1):
+    if not should_purge_cloudflare():
         return
 
-    paths_per_call = 29 # Cloudflare will only purge 30 paths at a time, use 29 for off-by-one safety
-    if len(paths) > paths_per_call:
-        print("Chunking paths, as too many to invalidate at once")
-        print("Chunked paths: ", chunked_list(paths, paths_per_call))
+    failed = cloudflare.get_client().purge_tags(tags)
+    if failed:
+        requeue_cloudflare_purge(purge_cloudflare_tags, failed, attempt, f'tags {failed}')
 
-    for paths_chunk in chunked_list(paths, paths_per_call):
 
-        print(f'Invalidating {paths_chunk} on Cloudflare')
-        purge_url = f'https://api.cloudflare.com/client/v4/zones/{settings.CLOUDFLARE_ZONE_ID}/purge_cache'
-        headers = {
-            'Authorization': f'Bearer {settings.CLOUDFLARE_API_TOKEN}',
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        }
+INVALIDATION_BATCH_SIZE = 50
+
+
+def record_invalidations(invalidated):
+    now = timezone.now()
+    for url, created in invalidated:
+        page_cache.record_path(url, invalidations=1, age_at_invalidation=(now - created).total_seconds())
 
-        data = {
-            'files': [f'https://{settings.CLOUDFLARE_DOMAIN}{path}' for path in paths_chunk]
-        }
 
-        print(f'Purging {paths_chunk} from Cloudflare using url: {purge_url}, headers: {headers}, data: {data}')
-        response = requests.post(purge_url, headers=headers, data=json.dumps(data))
-        print(f'Cloudflare response: {response.text}')
-        if response.status_code != 200:
-            raise Exception(f'Cloudflare purge of {paths_chunk} failed with status code {response.status_code} and message {response.text}')
+def delete_page_caches(caches):
+    PageDependency.objects.filter(page__in=caches).delete()
+    return caches.delete()[0]
 
 
-def invalidate_pages(pages_to_invalidate):
+# Retried quickly, as until it succeeds visitors are served the pages it invalidates
+@queue.task_policy(retries=5, backoff=5)
+def invalidate_pages(pages_to_invalidate, urls=(), tags=()):
+    """
+    Invalidate every cached page beginning with one of pages_to_invalidate, plus the exact urls and the pages
+    rendered from anything in tags (see cache.cache_tags), and return the number of pages invalidated
+    """
     if pages_to_invalidate == 'all':
         print('Invalidating all pages')
-        # Purge all on cloudflare before deleting
-        #for page in PageCache.objects.all():
-            #page.delete()
-        #for page in PageCache.objects.all():
-            #purge_cloudflare_page(page.url)
-        PageCache.objects.all().delete()
+        previous = list(PageCache.objects.values_list('url', 'created'))
+        previous_urls = [url for url, _ in previous]
+        record_invalidations(previous)
+        if settings.PAGE_CACHE_STALE_WHILE_REVALIDATE:
+            PageCache.objects.filter(stale_since=None).update(stale_since=timezone.now())
+        else:
+            delete_page_caches(PageCache.objects.all())
+        page_cache.discard_all()
+        print(f'Invalidated {len(previous_urls)} cached pages')
+        # Purged by tag rather than purging everything, which would also drop static and media files
+        queue_cloudflare_purge(purge_cloudflare_tags, [page_cache.PAGE_TAG])
+        if settings.PAGE_CACHE_WARMING:
+            queue.add_task(page_cache.warm_page_cache, previous_urls, queue='cache')
+        # Last, as the stats for every page take a while to write
+        page_cache.flush_path_stats()
+        return len(previous_urls)
     else:
-        print(f'Invalidating {pages_to_invalidate} locally')
-        for page in pages_to_invalidate:
-            # Remove all PageCaches that begin with the page
-            for cache in PageCache.objects.filter(url__startswith=page):
-                cache.delete()
-        purge_cloudflare_pages(pages_to_invalidate)
+        print(f'Invalidating {pages_to_invalidate} and tags {list(tags)} locally')
+        prefixes = page_cache.collapse_prefixes(pages_to_invalidate)
+        tagged_urls = []
+        if tags:
+            # Pages cached before dependencies were tracked can't be found by tag
+            tagged_urls = page_cache.tagged_urls(tags) + page_cache.untracked_urls()
+        exact_urls = [url for url in set(urls) | set(tagged_urls) if not any(url.startswith(prefix) for prefix in prefixes)]
+        conditions = [page_cache.prefix_filter(prefix) for prefix in prefixes]
+        conditions += [Q(url__in=chunk) for chunk in chunked_list(exact_urls, INVALIDATION_BATCH_SIZE)]
+
+        invalidated_urls = []
+        for batch in chunked_list(conditions, INVALIDATION_BATCH_SIZE):
+            condition = Q()
+            for batch_condition in batch:
+                condition |= batch_condition
+            # Remove all matching PageCaches, or mark them stale to be served while re-rendering
+            caches = PageCache.objects.filter(condition)
+            invalidated = list(caches.values_list('url', 'created'))
+            invalidated_urls += [url for url, _ in invalidated]
+            record_invalidations(invalidated)
+            if settings.PAGE_CACHE_STALE_WHILE_REVALIDATE:
+                caches.filter(stale_since=None).update(stale_since=timezone.now())
+            else:
+                delete_page_caches(caches)
+        page_cache.discard(invalidated_urls)
+        print(f'Invalidated {len(invalidated_urls)} cached pages')
+        cloudflare_paths = list(pages_to_invalidate) + [url for url in urls if url not in pages_to_invalidate]
+        if cloudflare_paths:
+            queue_cloudflare_purge(purge_cloudflare_pages, cloudflare_paths)
+        if tags:
+            queue_cloudflare_purge(purge_cloudflare_tags, list(tags))
+        if settings.PAGE_CACHE_WARMING and invalidated_urls:
+            queue.add_task(page_cache.warm_page_cache, invalidated_urls, include_sitemaps=False, queue='cache')
+        page_cache.flush_path_stats()
+        return len(invalidated_urls)
+
+
+def evict_page_cache():
+    """
+    Evict pages that haven't been hit for PAGE_CACHE_TTL seconds, then the least recently (lru) or least frequently
+    (lfu) used pages until the stored pages fit in PAGE_CACHE_MAX_BYTES. Returns the number of pages evicted
+    """
+    caches = PageCache.objects.annotate(last_used=Coalesce('last_hit', 'created'))
+    victims = list(caches.filter(last_used__lt=timezone.now() - timedelta(seconds=settings.PAGE_CACHE_TTL))
+                   .values_list('id', 'url', 'size'))
+    expired_count = len(victims)
+
+    total_size = caches.aggregate(total=Sum('size'))['total'] or 0
+    excess = total_size - sum(size for _, _, size in victims) - settings.PAGE_CACHE_MAX_BYTES
+    if excess > 0:
+        order = ('hits', 'last_used') if settings.PAGE_CACHE_EVICTION_POLICY == 'lfu' else ('last_used',)
+        expired_ids = {pk for pk, _, _ in victims}
+        for pk, url, size in caches.order_by(*order).values_list('id', 'url', 'size').iterator():
+            if excess <= 0:
+                break
+            if pk not in expired_ids:
+                victims.append((pk, url, size))
+                excess -= size
+
+    for chunk in chunked_list(victims, 500):
+        delete_page_caches(PageCache.objects.filter(id__in=[pk for pk, _, _ in chunk]))
+    if victims:
+        page_cache.discard([url for _, url, _ in victims])
+    print(f'Evicted {len(victims)} cached pages ({expired_count} expired), '
+          f'freeing {sum(size for _, _, size in victims)} of {total_size} bytes')
+    return len(victims)
+
+
+def merge_invalidations(pages_to_invalidate, urls, tags, other_pages, other_urls, other_tags):
+    """Combine two sets of invalidate_pages arguments into one"""
+    if pages_to_invalidate == 'all' or other_pages == 'all':
+        return 'all', [], []
+    return (sorted(set(pages_to_invalidate) | set(other_pages)), sorted(set(urls) | set(other_urls)),
+            sorted(set(tags) | set(other_tags)))
+
+
+# Invalidations collected during the current request or transaction on this thread
+_pending_invalidations = threading.local()
+
+
+@contextmanager
+def collect_invalidations():
+    """
+    Hold the invalidations queued inside the block, like a request (see middleware.CollectInvalidations), and queue
+    them as one when it ends
+    """
+    _pending_invalidations.in_request = True
+    try:
+        yield
+    finally:
+        _pending_invalidations.in_request = False
+        flush_invalidations()
+
+
+def queue_invalidation(pages_to_invalidate, urls=(), tags=()):
+    """
+    Collect an invalidation to be queued, merged with the others from the same request or transaction, when the
+    request finishes or the transaction commits
+    """
+    if not pages_to_invalidate and not urls and not tags:
+        return
+    pending = getattr(_pending_invalidations, 'pending', None) or ([], [], [])
+    _pending_invalidations.pending = merge_invalidations(*pending, pages_to_invalidate, urls, tags)
+    if not getattr(_pending_invalidations, 'in_request', False):
+        # Runs straight away outside of a transaction
+        transaction.on_commit(flush_invalidations)
+
+
+def flush_invalidations():
+    pending = getattr(_pending_invalidations, 'pending', None)
+    if pending is None:
+        return
+    _pending_invalidations.pending = None
+    try:
+        queue_debounced_invalidation(*pending)
+    except Exception:
+        # Kept to be queued with the next flush on this thread, rather than lost
+        queued_since = getattr(_pending_invalidations, 'pending', None)
+        _pending_invalidations.pending = merge_invalidations(*pending, *queued_since) if queued_since else pending
+        raise
+
+
+def merge_invalidation_tasks(args, kwargs, other_args, other_kwargs):
+    pages_to_invalidate, urls, tags = merge_invalidations(
+        args[0], kwargs.get('urls', []), kwargs.get('tags', []),
+        other_args[0], other_kwargs.get('urls', []), other_kwargs.get('tags', [])
+    )
+    return [pages_to_invalidate], {'urls': urls, 'tags': tags}
+
+
+def queue_debounced_invalidation(pages_to_invalidate, urls, tags):
+    """
+    Queue invalidate_pages to run after PAGE_CACHE_INVALIDATION_DELAY seconds, or merge into an invalidation already
+    waiting to run, so a burst of saves across requests results in a single invalidation
+    """
+    queue.add_task(invalidate_pages, pages_to_invalidate, urls=urls, tags=tags,
+                   scheduled_time=timezone.now() + timedelta(seconds=settings.PAGE_CACHE_INVALIDATION_DELAY),
+                   queue='cache', priority=10, dedupe_key='invalidate_pages', merge=merge_invalidation_tasks)
 
 
 # Invalidate pagecache on model save
 @receiver(post_save)
-def invalidate_page_cache(sender, instance, **kwargs):
+def invalidate_page_cache(sender, instance, created=False, **kwargs):
     if hasattr(instance, 'get_caches_to_invalidate'):
+        changed_fields = getattr(instance, 'changed_fields', None)
+        if created:
+            previous = None
+        elif changed_fields is not None:
+            if not changed_fields & rendered_field_names(sender):
+                print(f"Skipping cache invalidation for {sender.__name__} {instance.pk}, no rendered fields changed")
+                take_snapshot(instance)
+                return
+            previous = previous_instance(instance)
+        else:
+            previous = sender.objects.get(pk=instance.pk) if instance.pk else None
+        take_snapshot(instance)
+
         print("Postsave cache invalidation from sender ", sender, ", and instance ", instance)
-        pages_to_invalidate = instance.get_caches_to_invalidate(sender.objects.get(pk=instance.pk) if instance.pk else None)
+        pages_to_invalidate = instance.get_caches_to_invalidate(previous)
+        tags = []
+        if hasattr(instance, 'get_cache_tags_to_invalidate'):
+            tags = instance.get_cache_tags_to_invalidate(previous)
+        if created:
+            dependent_urls = []
+        elif pages_to_invalidate == 'all':
+            dependent_urls = []
+            if not changes_listings(instance):
+                # Every page showing the instance loaded it while rendering, so only those (and pages whose
+                # dependencies weren't recorded) need invalidating
+                pages_to_invalidate = []
+                dependent_urls = page_cache.dependent_urls(instance) + page_cache.untracked_urls()
+        else:
+            # Pages that loaded this instance while rendering, on top of the model's own invalidation. The model's
+            # pages are always kept, as a change can add the instance to listings that never loaded it
+            dependent_urls = page_cache.dependent_urls(instance)
         #invalidate_pages(pages_to_invalidate)
-        queue.add_task(invalidate_pages, pages_to_invalidate)
+        queue_invalidation(pages_to_invalidate, dependent_urls, tags)
 
 
 class Testimonial(models.Model):
@@ -1209,7 +1558,8 @@ def queue_link_registration(sender, instance, **_):
     if not (normal_model and has_rich_text):
         return
 
-    queue.add_task(register_links, sender.__name__, instance.pk)
+    queue.enqueue_on_commit(register_links, sender.__name__, instance.pk, queue='links',
+                            dedupe_key=f"register_links:{sender.__name__}:{instance.pk}")
 
 def register_links(model_name: str, instance_pk: str) -> None:
     sender = globals()[model_name]
@@ -1255,9 +1605,9 @@ def register_all_links():
     all_models = filter(lambda model: not model.__name__.startswith("Historical"), apps.get_app_config('main').get_models())
     models_with_rich_content = filter(lambda model: any([field.__class__.__name__ == "RichTextUploadingField" for field in model._meta.get_fields()]), all_models)
     for model in models_with_rich_content:
-        pks = map(lambda pk: pk["pk"], model.objects.all().values('pk'))
-        for pk in pks:
-            queue.add_task(register_links, model.__name__, pk)
+        pks = model.objects.values_list('pk', flat=True).iterator(chunk_size=500)
+        # Below links registered on save, which shouldn't wait for the whole site to be re-registered
+        queue.add_tasks(queue.make_task(register_links, model.__name__, pk, queue='links', priority=-10) for pk in pks)
 
 def check_links(batch_size=10):
     unchecked = Link.objects.filter(broken=None)[:batch_size]
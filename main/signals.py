@@ -8,11 +8,24 @@ from vectordb.sync_signals import (
 from vectordb import vectordb
 
 from .models import Article, Page, Tour, DestinationDetails
-from job_queue.utils import add_task
+from job_queue.utils import add_tasks, enqueue_on_commit, make_task
 
 def queue_sync(sender, instance, created=None, **kwargs):
     kwargs["signal"] = None  # Avoid having to serialize and deserialize the signal reference
-    add_task(sync_vectordb_on_create_update, sender.__name__, instance.pk, created, **kwargs)
+    # Later saves replace a waiting sync, which re-reads the instance anyway
+    enqueue_on_commit(sync_vectordb_on_create_update, sender.__name__, instance.pk, created, queue='vectordb',
+                      dedupe_key=f"sync_vectordb:{sender.__name__}:{instance.pk}", **kwargs)
+
+def queue_sync_all(batch_size=500):
+    """Queue a vectordb sync of every instance of the synced models, streaming them in batches"""
+    count = 0
+    for model in SYNCED_MODELS:
+        pks = model.objects.values_list('pk', flat=True).iterator(chunk_size=batch_size)
+        # Without dedupe keys so they can be inserted in bulk, and below syncs queued on save
+        count += add_tasks((make_task(sync_vectordb_on_create_update, model.__name__, pk, queue='vectordb',
+                                      priority=-10)
+                            for pk in pks), batch_size=batch_size)
+    return count
 
 def logged_sync(sender, instance, created=None, **kwargs):
     print("syncing on save with paramaters: ", sender, instance, created, kwargs)
@@ -70,7 +83,7 @@ def connect_signals(model):
     )
 
 
-connect_signals(Article)
-connect_signals(Page)
-connect_signals(Tour)
-connect_signals(DestinationDetails)
+SYNCED_MODELS = [Article, Page, Tour, DestinationDetails]
+
+for synced_model in SYNCED_MODELS:
+    connect_signals(synced_model)
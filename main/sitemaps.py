@@ -107,3 +107,16 @@ class StaticPagesMap(Sitemap):
 
     def location(self, item):
         return reverse(item)
+
+
+sitemaps = {
+    'tours': TourSitemap,
+    'pages': PageSitemap,
+    'articles': ArticleSitemap,
+    'details': DetailsSitemap,
+    'regiontours': RegionToursMap,
+    'regionguides': RegionGuidesMap,
+    'destinationtours': DestinationToursMap,
+    'destinationguides': DestinationGuidesMap,
+    'static': StaticPagesMap
+}
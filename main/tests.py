@@ -1,12 +1,37 @@
+import gzip
+import json
 import os
+import re
+import threading
+from contextlib import redirect_stdout
+from datetime import timedelta
+from html.parser import HTMLParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
 
 from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import LiveServerTestCase, override_settings
+from django.http import HttpResponse, QueryDict
+from django.test import LiveServerTestCase, RequestFactory, SimpleTestCase, TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from playwright.sync_api import sync_playwright
 
-from .models import Article, Settings
+from . import cache as page_cache, models as main_models
+from .cache import (
+    PAGE_TAG, cache_key, cache_tags, collapse_prefixes, flush_path_stats, prefix_filter, record_path, url_section
+)
+from .cloudflare import CloudflarePurgeClient
+from .middleware import CacheForUsers
+from .minify import minify_html
+from .models import (
+    Article, Author, MapPoint, PageCache, PageCacheStats, PageDependency, Region, Settings, Tag, collect_invalidations,
+    find_changed_fields, invalidate_pages, purge_cloudflare_tags, queue_invalidation, rendered_field_names
+)
 
 small_gif = (
     b'\x47\x49\x46\x38\x39\x61\x01\x00\x01\x00\x00\x00\x00\x21\xf9\x04'
@@ -81,3 +106,613 @@ class IntegrationTests(LiveServerTestCase):
         # save screenshot
         with open('screenshot.png', 'wb') as f:
             f.write(screenshot)
+
+
+class DocumentTokens(HTMLParser):
+    """The tags, attributes and text of a document, ignoring comments and insignificant whitespace"""
+    raw_elements = ('pre', 'textarea', 'script', 'style')
+
+    def __init__(self, html):
+        super().__init__(convert_charrefs=False)
+        self.tokens = []
+        self.raw_depth = 0
+        self.feed(html)
+        self.close()
+
+    def handle_starttag(self, tag, attrs):
+        self.tokens.append(('start', tag, attrs))
+        if tag in self.raw_elements:
+            self.raw_depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.tokens.append(('start', tag, attrs))
+
+    def handle_endtag(self, tag):
+        self.tokens.append(('end', tag))
+        if tag in self.raw_elements and self.raw_depth:
+            self.raw_depth -= 1
+
+    def handle_data(self, data):
+        if not self.raw_depth:
+            data = re.sub(r'\s+', ' ', data)
+        # Merge text split up by removed comments
+        if self.tokens and self.tokens[-1][0] == 'data':
+            data = self.tokens.pop()[1] + data
+            if not self.raw_depth:
+                data = re.sub(r'\s+', ' ', data)
+        self.tokens.append(('data', data))
+
+    def handle_entityref(self, name):
+        self.handle_data(f'&{name};')
+
+    def handle_charref(self, name):
+        self.handle_data(f'&#{name};')
+
+    def handle_decl(self, decl):
+        self.tokens.append(('decl', decl))
+
+
+class MinifyTests(SimpleTestCase):
+    def assertEquivalent(self, html):
+        minified = minify_html(html.encode('utf-8')).decode('utf-8')
+        self.assertEqual(DocumentTokens(html).tokens, DocumentTokens(minified).tokens)
+        return minified
+
+    def test_collapses_whitespace(self):
+        minified = self.assertEquivalent('<div>\n    <p>Hello   <b>world</b>  </p>\n\n</div>')
+        self.assertEqual(minified, '<div>\n<p>Hello <b>world</b> </p>\n</div>')
+
+    def test_strips_comments(self):
+        minified = self.assertEquivalent('<p>a <!-- comment\n with -- dashes --> b</p><!---->')
+        self.assertEqual(minified, '<p>a b</p>')
+
+    def test_keeps_conditional_comments(self):
+        html = '<!--[if IE]><p>Old browser</p><![endif]-->'
+        self.assertEqual(minify_html(html.encode('utf-8')).decode('utf-8'), html)
+
+    def test_keeps_raw_elements(self):
+        for html in ('<pre>  a\n\n   b  </pre>',
+                     '<TEXTAREA name="t">  x  </textarea>',
+                     '<script>\n  var s = "<!-- not a comment -->";  </script>',
+                     '<style>\n  p  >  a { color: red; }\n</style>'):
+            with self.subTest(html=html):
+                self.assertEqual(self.assertEquivalent(html), html)
+
+    def test_custom_elements_are_not_raw(self):
+        minified = self.assertEquivalent('<pre-x>  a  </pre-x><p>  b  </p><style-foo>  c </style-foo>')
+        self.assertEqual(minified, '<pre-x> a </pre-x><p> b </p><style-foo> c </style-foo>')
+
+    def test_unclosed_raw_element(self):
+        html = '<p> a </p><script>  var a = 1;'
+        self.assertEqual(minify_html(html.encode('utf-8')), b'<p> a </p><script>  var a = 1;')
+
+    def test_collapses_whitespace_in_tags(self):
+        minified = self.assertEquivalent('<a   href="/a  b"\n   class=\'x  y\'  data-x="1 > 0" >link</a>')
+        self.assertEqual(minified, '<a href="/a  b" class=\'x  y\' data-x="1 > 0">link</a>')
+
+    def test_unquoted_attribute_before_self_closing(self):
+        self.assertEqual(minify_html(b'<a href=x/ >l</a><br / >'), b'<a href=x/>l</a><br />')
+
+    def test_keeps_non_ascii(self):
+        self.assertEquivalent('<p>Ha\u00a0Long   Bay \u2014 Vi\u1ec7t Nam</p>')
+
+    def test_accepts_str(self):
+        self.assertEqual(minify_html('<p>  a  </p>'), b'<p> a </p>')
+
+    def test_templates_are_equivalent(self):
+        templates = Path(__file__).parent / 'templates' / 'main'
+        for template in sorted(templates.glob('*.html')):
+            with self.subTest(template=template.name):
+                self.assertEquivalent(template.read_text(encoding='utf-8'))
+
+
+class FakePurgeServer(ThreadingHTTPServer):
+    """Local stand-in for Cloudflare's purge endpoint, replying with queued (status, headers) responses then 200s"""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakePurgeHandler)
+        self.responses = []
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def api_base(self):
+        return f'http://127.0.0.1:{self.server_port}/client/v4'
+
+
+class FakePurgeHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.requests.append((self.path, dict(self.headers), body))
+            status, headers = self.server.responses.pop(0) if self.server.responses else (200, {})
+        content = json.dumps({'success': status == 200, 'errors': [], 'messages': []}).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CloudflarePurgeClientTests(SimpleTestCase):
+    def setUp(self):
+        self.server = FakePurgeServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = CloudflarePurgeClient('zone', 'secret-token', 'example.com', api_base=self.server.api_base,
+                                            concurrency=3, max_retries=2, backoff=0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def purge(self, paths):
+        output = StringIO()
+        with redirect_stdout(output):
+            failed = self.client.purge_paths(paths)
+        self.assertNotIn('secret-token', output.getvalue())
+        return failed
+
+    def test_purges_in_chunks(self):
+        paths = [f'/tour/{i}' for i in range(70)]
+        self.assertEqual(self.purge(paths), [])
+        self.assertEqual(len(self.server.requests), 3)
+        purged = [url for _, _, body in self.server.requests for url in body['files']]
+        self.assertCountEqual(purged, [f'https://example.com{path}' for path in paths])
+        path, headers, _ = self.server.requests[0]
+        self.assertEqual(path, '/client/v4/zones/zone/purge_cache')
+        self.assertEqual(headers['Authorization'], 'Bearer secret-token')
+
+    def test_retries_rate_limits_and_server_errors(self):
+        self.server.responses = [(429, {'Retry-After': '0'}), (503, {})]
+        self.assertEqual(self.purge(['/a', '/b']), [])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_returns_paths_that_keep_failing(self):
+        self.server.responses = [(500, {})] * 3
+        self.assertEqual(self.purge(['/a', '/b']), ['/a', '/b'])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_does_not_retry_client_errors(self):
+        self.server.responses = [(400, {})]
+        self.assertEqual(self.purge(['/a']), ['/a'])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_leaves_long_rate_limits_to_the_retry_queue(self):
+        self.server.responses = [(429, {'Retry-After': '3600'})]
+        self.assertEqual(self.purge(['/a']), ['/a'])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_purges_tags_and_everything(self):
+        with redirect_stdout(StringIO()):
+            self.assertEqual(self.client.purge_tags(['main.mappoint', 'main.positiontemplate:3']), [])
+            self.assertTrue(self.client.purge_everything())
+        self.assertEqual([body for _, _, body in self.server.requests],
+                         [{'tags': ['main.mappoint', 'main.positiontemplate:3']}, {'purge_everything': True}])
+
+
+class PrefixTests(TestCase):
+    def test_collapse_prefixes(self):
+        self.assertEqual(collapse_prefixes(['/tour/a', '/tour/', '/news/', '/tour/', '/newsletter/']),
+                         ['/news/', '/newsletter/', '/tour/'])
+        self.assertEqual(collapse_prefixes(['/t', '/tour/', '/about/']), ['/about/', '/t'])
+        self.assertEqual(collapse_prefixes(['/', '/tour/']), ['/'])
+        self.assertEqual(collapse_prefixes([]), [])
+
+    def test_prefix_filter(self):
+        urls = ['/', '/tour/a', '/tour/b', '/tours/', '/news/?page=2', '/newsletter/']
+        for url in urls:
+            PageCache.objects.create(url=url, section=url_section(url), content='')
+        # Stored before the section column existed
+        PageCache.objects.create(url='/tour/old', section=None, content='')
+
+        def matching(prefix):
+            return set(PageCache.objects.filter(prefix_filter(prefix)).values_list('url', flat=True))
+
+        self.assertEqual(matching('/tour/'), {'/tour/a', '/tour/b', '/tour/old'})
+        self.assertEqual(matching('/tour/a'), {'/tour/a'})
+        self.assertEqual(matching('/tour'), {'/tour/a', '/tour/b', '/tour/old', '/tours/'})
+        self.assertEqual(matching('/news'), {'/news/?page=2', '/newsletter/'})
+        self.assertEqual(matching('/'), set(urls) | {'/tour/old'})
+
+
+class CacheKeyTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        with redirect_stdout(StringIO()):
+            Tag.objects.create(name='Food')
+            Author.objects.create(name='Ann', picture='ann.gif', blurb='', published_bool=True)
+            Author.objects.create(name='Draft', picture='draft.gif', blurb='')
+
+    def key(self, path, query):
+        return cache_key(path, QueryDict(query))
+
+    def test_without_query(self):
+        self.assertEqual(self.key('/about/', ''), '/about/')
+
+    def test_disallowed(self):
+        self.assertIsNone(self.key('/about/', 'page=2'))
+        self.assertIsNone(self.key('/news/', 'q=rice'))
+
+    def test_canonical_order_and_defaults(self):
+        self.assertEqual(self.key('/news/', 'page=1&start='), '/news/')
+        self.assertEqual(self.key('/news/', 'start=2024-01-05&page=02'), '/news/?page=2&start=2024-01-05')
+        self.assertEqual(self.key('/news/', 'start=2024-1-5'), '/news/?start=2024-01-05')
+        # Views read the last value
+        self.assertEqual(self.key('/news/', 'page=3&page=4'), '/news/?page=4')
+
+    def test_invalid_values(self):
+        for query in ('page=0', 'page=-1', 'page=abc', 'page=100000', 'start=yesterday', 'author=Zed', 'author=Draft'):
+            self.assertIsNone(self.key('/news/', query), query)
+
+    def test_presence_only_params(self):
+        self.assertEqual(self.key('/blog/', 'tag-food=on'), '/blog/?tag-food=')
+        self.assertEqual(self.key('/blog/', 'tag-food=x&author-Ann=y'), '/blog/?author-Ann=&tag-food=')
+        self.assertIsNone(self.key('/blog/', 'tag-drink='))
+        self.assertIsNone(self.key('/blog/', 'author-Draft='))
+        self.assertEqual(self.key('/blog/', 'author=Ann'), '/blog/?author=Ann')
+
+    def test_tour_parent(self):
+        self.assertEqual(self.key('/tour/a', 'parent='), '/tour/a')
+        self.assertIsNone(self.key('/tour/a', 'parent=missing'))
+
+
+class ChangedFieldsTests(SimpleTestCase):
+    def loaded_article(self):
+        article = Article(slug='a', title='Title', content='<p>Text</p>')
+        # As if loaded by from_db, which is when the snapshot is trusted
+        article._state.adding = False
+        return article
+
+    def test_rendered_field_names(self):
+        fields = rendered_field_names(Article)
+        self.assertIn('title', fields)
+        self.assertIn('content', fields)
+        self.assertNotIn('creation', fields)
+        self.assertEqual(rendered_field_names(type('Rendered', (), {'rendered_fields': ['title']})), {'title'})
+
+    def test_finds_changed_fields(self):
+        article = self.loaded_article()
+        find_changed_fields(Article, article)
+        self.assertEqual(article.changed_fields, set())
+        article.title = 'New title'
+        article.excerpt = 'Excerpt'
+        find_changed_fields(Article, article)
+        self.assertEqual(article.changed_fields, {'title', 'excerpt'})
+
+    def test_update_fields(self):
+        article = self.loaded_article()
+        article.title = 'New title'
+        article.excerpt = 'Excerpt'
+        find_changed_fields(Article, article, update_fields=['title', 'type'])
+        self.assertEqual(article.changed_fields, {'title'})
+
+    def test_unknown_for_new_instances(self):
+        article = Article(slug='a', title='Title')
+        find_changed_fields(Article, article)
+        self.assertIsNone(article.changed_fields)
+
+
+class InvalidateAllTests(TestCase):
+    def setUp(self):
+        with redirect_stdout(StringIO()):
+            Region.objects.create(slug='asia', name='Asia', published_bool=True)
+        self.region = Region.objects.get(slug='asia')
+        shown = PageCache.objects.create(url='/tours/asia/', section='tours', content='')
+        PageDependency.objects.create(page=shown, content_type=ContentType.objects.get_for_model(Region),
+                                      object_id='asia')
+        other = PageCache.objects.create(url='/about/', section='about', content='')
+        PageDependency.objects.create(page=other, content_type=ContentType.objects.get_for_model(Settings),
+                                      object_id='1')
+        PageCache.objects.create(url='/old/', section='old', content='')
+
+    def save(self, **changes):
+        for name, value in changes.items():
+            setattr(self.region, name, value)
+        with mock.patch('main.models.queue_invalidation') as queue_invalidation, redirect_stdout(StringIO()):
+            self.region.save()
+        return queue_invalidation.call_args.args
+
+    def test_narrows_to_pages_that_loaded_the_instance(self):
+        pages, urls, tags = self.save(guide_blurb='<p>Fixed a typo</p>')
+        self.assertEqual(pages, [])
+        # Pages cached without recorded dependencies may show it too
+        self.assertEqual(sorted(urls), ['/old/', '/tours/asia/'])
+
+    def test_keeps_all_when_listings_change(self):
+        self.assertEqual(self.save(list_order=3)[0], 'all')
+        self.assertEqual(self.save(published_bool=False, guide_blurb='<p>Hidden</p>')[0], 'all')
+
+    def test_keeps_all_when_changes_are_unknown(self):
+        del self.region._snapshot
+        self.assertEqual(self.save(guide_blurb='<p>Fixed a typo</p>')[0], 'all')
+
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    settings.PAGE_CACHE_SHARED_ALIAS: {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'pages',
+        'TIMEOUT': None,
+    },
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHES, PRODUCTION=True, CLOUDFLARE_API_TOKEN='token', NO_CACHE_INVALIDATION=False,
+                   PAGE_CACHE_WARMING=False, PAGE_CACHE_EXPORT=False)
+class CacheTagTests(TestCase):
+    def test_every_page_is_tagged(self):
+        self.assertEqual(cache_tags([]), PAGE_TAG)
+        self.assertEqual(cache_tags([(Region, 'asia'), (MapPoint, '2'), (MapPoint, '1')]),
+                         'page,main.mappoint,main.region,main.mappoint:1,main.mappoint:2,main.region:asia')
+
+    def test_header_is_capped(self):
+        header = cache_tags([(MapPoint, str(pk)) for pk in range(10000)])
+        self.assertLessEqual(len(header), 16 * 1024)
+        self.assertTrue(header.startswith('page,main.mappoint,main.mappoint:'))
+
+    def test_invalidating_all_purges_page_tag(self):
+        with mock.patch('main.models.queue.add_task') as add_task, redirect_stdout(StringIO()):
+            invalidate_pages('all')
+        self.assertEqual([call.args for call in add_task.call_args_list],
+                         [(purge_cloudflare_tags, [PAGE_TAG])])
+
+
+class CollectInvalidationsTests(SimpleTestCase):
+    def setUp(self):
+        # Left over by TestCases, whose transactions never commit
+        main_models._pending_invalidations.pending = None
+
+    def test_merges_invalidations_until_the_block_ends(self):
+        with mock.patch('main.models.queue_debounced_invalidation') as queue_debounced:
+            with collect_invalidations():
+                queue_invalidation(['/news/'], ['/a'], ['main.region'])
+                queue_invalidation(['/blog/', '/news/'], ['/b'])
+                queue_debounced.assert_not_called()
+        queue_debounced.assert_called_once_with(['/blog/', '/news/'], ['/a', '/b'], ['main.region'])
+
+    def test_keeps_invalidations_that_fail_to_queue(self):
+        with mock.patch('main.models.queue_debounced_invalidation', side_effect=RuntimeError) as queue_debounced:
+            with self.assertRaises(RuntimeError), collect_invalidations():
+                queue_invalidation(['/news/'])
+        with mock.patch('main.models.queue_debounced_invalidation') as queue_debounced:
+            with collect_invalidations():
+                queue_invalidation(['/blog/'])
+        queue_debounced.assert_called_once_with(['/blog/', '/news/'], [], [])
+
+
+class PathStatsTests(TestCase):
+    def test_flushes_in_batches(self):
+        PageCache.objects.create(url='/p0/', section='p0', content='')
+        PageCacheStats.objects.create(url='/p0/', hits=1, size=5)
+        for i in range(3):
+            record_path(f'/p{i}/', size=10 + i, hits=2)
+        record_path('/p1/', misses=1, render_time=0.5)
+        # An insert and an update of the stats, then an update of the cached pages' hits, per batch
+        with mock.patch('main.cache.PATH_STATS_BATCH_SIZE', 2), self.assertNumQueries(6):
+            flush_path_stats()
+
+        stats = {s.url: (s.hits, s.misses, s.render_time, s.size) for s in PageCacheStats.objects.all()}
+        self.assertEqual(stats, {'/p0/': (3, 0, 0, 10), '/p1/': (2, 1, 0.5, 11), '/p2/': (2, 0, 0, 12)})
+        self.assertEqual(PageCache.objects.get().hits, 2)
+
+        record_path('/p0/', hits=1)
+        flush_path_stats()
+        self.assertEqual(PageCacheStats.objects.values_list('hits', 'size').get(url='/p0/'), (4, 10))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, NOCACHE=False, PAGE_CACHE_EXPORT=False)
+class CacheForUsersTestCase(TestCase):
+    html = '<p>  Hello  </p>'
+
+    def setUp(self):
+        # Locmem caches and the memory tier outlive each test
+        page_cache.shared_cache().clear()
+        page_cache.memory_cache.clear()
+        self.addCleanup(page_cache._path_stats.clear)
+        self.renders = 0
+        self.middleware = CacheForUsers(self.render)
+
+    def render(self, request):
+        self.renders += 1
+        return HttpResponse(self.html)
+
+    def get(self, path='/about/', **headers):
+        request = RequestFactory().get(path, **headers)
+        request.user = AnonymousUser()
+        return self.middleware(request)
+
+
+class ConditionalGetTests(CacheForUsersTestCase):
+    def test_not_modified(self):
+        response = self.get()
+        self.assertEqual(response['DB-cache-status'], 'MISS')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        for headers in ({'HTTP_IF_NONE_MATCH': etag}, {'HTTP_IF_MODIFIED_SINCE': last_modified}):
+            with self.subTest(headers=headers):
+                response = self.get(**headers)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response['DB-cache-status'], 'HIT;not-modified')
+                self.assertEqual((response['ETag'], response['Last-Modified']), (etag, last_modified))
+                self.assertEqual(response.content, b'')
+        self.assertEqual(self.renders, 1)
+
+    def test_validators_from_database(self):
+        etag = self.get()['ETag']
+        page_cache.discard(['/about/'])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_changed_page(self):
+        self.get()
+        response = self.get(HTTP_IF_NONE_MATCH='W/"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['DB-cache-status'], 'HIT')
+        self.assertEqual(response.content, b'<p> Hello </p>')
+
+
+class PageEncodingTests(CacheForUsersTestCase):
+    html = '<p>  Hello  </p>' * 100
+    minified = b'<p> Hello </p>' * 100
+
+    def test_negotiate_encoding(self):
+        available = ('br', 'gzip')
+        self.assertEqual(page_cache.negotiate_encoding('gzip, deflate, br', available), 'br')
+        self.assertEqual(page_cache.negotiate_encoding('gzip;q=1, br;q=0.5', available), 'gzip')
+        self.assertEqual(page_cache.negotiate_encoding('br;q=0, *', available), 'gzip')
+        self.assertEqual(page_cache.negotiate_encoding('br', ('gzip',)), None)
+        self.assertEqual(page_cache.negotiate_encoding('', available), None)
+        self.assertEqual(page_cache.negotiate_encoding('gzip;q=x', available), None)
+
+    def test_serves_stored_gzip(self):
+        self.get()
+        response = self.get(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['DB-cache-status'], 'HIT')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(response.content), self.minified)
+
+    @skipUnless(page_cache.has_brotli, 'brotli is not installed')
+    def test_serves_stored_brotli(self):
+        import brotli
+
+        self.get()
+        response = self.get(HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+        self.assertEqual(brotli.decompress(response.content), self.minified)
+
+    def test_serves_identity(self):
+        self.get()
+        response = self.get(HTTP_ACCEPT_ENCODING='identity')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response.content, self.minified)
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+
+
+class PageCacheTierTests(CacheForUsersTestCase):
+    def test_promotes_from_database(self):
+        self.get()
+        page_cache.discard(['/about/'])
+        self.assertEqual(self.get()['DB-cache-status'], 'HIT')
+        self.assertIsNotNone(page_cache.shared_cache().get(page_cache.shared_key('/about/')))
+        # Served from the memory tier from now on
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get()['DB-cache-status'], 'HIT')
+        self.assertEqual(self.renders, 1)
+
+    def test_generation_clears_memory_tier(self):
+        self.get()
+        # Another worker deletes the page, leaving it in this worker's memory tier
+        PageCache.objects.all().delete()
+        page_cache.shared_cache().delete(page_cache.shared_key('/about/'))
+        self.assertEqual(self.get()['DB-cache-status'], 'HIT')
+
+        page_cache.bump_generation()
+        self.assertEqual(self.get()['DB-cache-status'], 'MISS')
+        self.assertEqual(self.renders, 2)
+
+    def test_page_invalidated_while_read_is_not_promoted(self):
+        self.get()
+        page = page_cache.memory_cache.get('/about/')
+        page_cache.memory_cache.clear()
+        generation = page_cache.shared_cache().get(page_cache.GENERATION_KEY)
+        page_cache.bump_generation()
+        page_cache.promote(page, generation=generation)
+        self.assertIsNone(page_cache.memory_cache.get('/about/'))
+        page_cache.promote(page)
+        self.assertIsNotNone(page_cache.memory_cache.get('/about/'))
+
+
+class SingleFlightTests(CacheForUsersTestCase):
+    def test_waits_for_renderer(self):
+        self.assertTrue(page_cache.acquire_render_lock('/about/'))
+        self.assertFalse(page_cache.acquire_render_lock('/about/'))
+        page = page_cache.CachedPage(url='/about/', content=b'<p>Rendered</p>', etag='rendered')
+        # The renderer stores the page in the shared tier while this request waits
+        timer = threading.Timer(0.2, page_cache.shared_cache().set, [page_cache.shared_key('/about/'), page])
+        timer.start()
+        self.addCleanup(timer.join)
+
+        response = self.get()
+        self.assertEqual(response['DB-cache-status'], 'HIT;waited')
+        self.assertEqual(response.content, b'<p>Rendered</p>')
+        self.assertEqual(self.renders, 0)
+
+    def test_renders_when_renderer_gives_up(self):
+        page_cache.acquire_render_lock('/about/')
+        timer = threading.Timer(0.2, page_cache.release_render_lock, ['/about/'])
+        timer.start()
+        self.addCleanup(timer.join)
+
+        self.assertEqual(self.get()['DB-cache-status'], 'MISS')
+        self.assertEqual(self.renders, 1)
+
+    def test_releases_lock(self):
+        self.get()
+        self.assertTrue(page_cache.acquire_render_lock('/about/'))
+        self.middleware = CacheForUsers(mock.Mock(side_effect=RuntimeError))
+        with self.assertRaises(RuntimeError):
+            self.get('/other/')
+        self.assertTrue(page_cache.acquire_render_lock('/other/'))
+
+
+@override_settings(PAGE_CACHE_MAX_STALENESS=60)
+class StaleWhileRevalidateTests(CacheForUsersTestCase):
+    def mark_stale(self, seconds_ago=0):
+        PageCache.objects.update(stale_since=timezone.now() - timedelta(seconds=seconds_ago))
+        page_cache.discard(['/about/'])
+
+    def test_serves_stale_page_while_refreshing(self):
+        self.get()
+        self.mark_stale(seconds_ago=10)
+        with mock.patch('job_queue.utils.add_task') as add_task:
+            for _ in range(2):
+                response = self.get()
+                self.assertEqual(response['DB-cache-status'], 'STALE')
+                self.assertGreaterEqual(int(response['Age']), 0)
+        # Once, however many requests see the stale page
+        add_task.assert_called_once_with(page_cache.refresh_page, '/about/', queue='cache', priority=5)
+        self.assertEqual(self.renders, 1)
+
+    def test_refresh_replaces_stale_page(self):
+        self.get()
+        self.mark_stale()
+        with mock.patch('job_queue.utils.add_task'):
+            self.get()
+        request = RequestFactory().get('/about/', **{page_cache.REFRESH_ENVIRON_KEY: True})
+        request.user = AnonymousUser()
+        self.assertEqual(self.middleware(request)['DB-cache-status'], 'MISS')
+        self.assertIsNone(PageCache.objects.get().stale_since)
+        self.assertEqual(self.get()['DB-cache-status'], 'HIT')
+
+    def test_renders_expired_page(self):
+        self.get()
+        self.mark_stale(seconds_ago=120)
+        # Not promoted, so other requests don't serve it from the upper tiers
+        self.assertIsNotNone(page_cache.get_page('/about/'))
+        self.assertIsNone(page_cache.memory_cache.get('/about/'))
+
+        with mock.patch('job_queue.utils.add_task') as add_task:
+            self.assertEqual(self.get()['DB-cache-status'], 'MISS')
+        add_task.assert_not_called()
+        self.assertEqual(self.renders, 2)
+
+    def test_expired_page_is_not_modified(self):
+        etag = self.get()['ETag']
+        self.mark_stale(seconds_ago=120)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_waiting_request_ignores_stale_page(self):
+        self.get()
+        self.mark_stale()
+        page_cache.get_page('/about/')  # Promotes the stale page to the shared tier
+        page_cache.acquire_render_lock('/about/')
+        with override_settings(PAGE_CACHE_SINGLE_FLIGHT_WAIT=0.2):
+            self.assertIsNone(page_cache.wait_for_page('/about/'))
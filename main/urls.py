@@ -43,6 +43,7 @@ urlpatterns = [
     path('purge_cache/', views.purge_cache, name='purge-cache'),
     path('list_links/', views.list_links, name='list-links'),
     path('links/', views.links_list, name='links'),
+    path('cache_stats/', views.cache_stats, name='cache-stats'),
 
     path('robots.txt', TemplateView.as_view(template_name='main/robots.txt', content_type='text/plain'), name='robots'),
 
@@ -52,6 +53,7 @@ urlpatterns = [
     path('api/link_status/', views.get_link_check_status, name='link_status'),
     path('api/check_links/', views.recheck_links, name='check_links'),
     path('api/check_broken_links/', views.recheck_broken_links, name='check_broken_links'),
+    path('api/cache_stats/', views.cache_stats_json, name='cache_stats'),
 
     path('<path:path>/', views.page, name='page')
 ]
@@ -32,6 +32,7 @@ from vectordb import vectordb
 
 from .forms import *
 from .models import *
+from . import cache as page_cache
 from .images import crop_to_dims, get_image_format
 from .widgets import CountrySelectWidget
 
@@ -58,11 +59,6 @@ class FrontPageRow:
     colour_after: Optional[str] = None
 
 
-def minify_html(html):
-    soup = BeautifulSoup(html, 'html.parser')
-    return str(soup)
-
-
 # Create your views here.
 @silk_profile(name='Home Page')
 def front_page(request):
@@ -834,6 +830,39 @@ def purge_cache(request):
         raise Http404
 
 
+def cache_stats_order(request):
+    order = request.GET.get('order', 'render_time')
+    return order if order in page_cache.PATH_STAT_ORDERS else 'render_time'
+
+
+def cache_stats(request):
+    if not request.user.is_staff:
+        raise Http404
+
+    page_cache.flush_path_stats()
+    order = cache_stats_order(request)
+    context = {
+        'order': order,
+        'orders': page_cache.PATH_STAT_ORDERS.keys(),
+        'stats': page_cache.worst_paths(order),
+        'tiers': page_cache.tier_stats(),
+    }
+    return render(request, 'main/cache_stats.html', context)
+
+
+def cache_stats_json(request):
+    if not request.user.is_staff:
+        raise Http404
+
+    page_cache.flush_path_stats()
+    order = cache_stats_order(request)
+    return JsonResponse({
+        'order': order,
+        'tiers': page_cache.tier_stats(),
+        'pages': [stats.as_dict() for stats in page_cache.worst_paths(order)],
+    })
+
+
 def testimonials(request):
     if not Settings.load().testimonials_active and not request.user.is_staff:
         raise Http404
@@ -1132,7 +1161,7 @@ def ai_answer(request):
 def reset_broken_links(request):
     from job_queue.models import Task
     Task.objects.filter(job="main.models.register_links").delete()
-    add_task(register_all_links)
+    add_task(register_all_links, queue='links')
     messages.add_message(request, messages.SUCCESS, 'All links are being rechecked now')
     return redirect('admin:main_link_changelist')
 
@@ -26,8 +26,19 @@ env = environ.Env(
     CLOUDFLARE_API_TOKEN=(str, None),
     CLOUDFLARE_ZONE_ID=(str, None),
     CLOUDFLARE_DOMAIN=(str, None),
+    CLOUDFLARE_API_BASE=(str, 'https://api.cloudflare.com/client/v4'),
     NOCACHE=(bool, False),
     NO_CACHE_INVALIDATION=(bool, False),
+    PAGE_CACHE_MEMORY_MB=(int, 64),
+    PAGE_CACHE_SHARED_MB=(int, 1024),
+    PAGE_CACHE_DATABASE_MB=(int, 1024),
+    PAGE_CACHE_TTL=(int, 7 * 24 * 60 * 60),
+    PAGE_CACHE_EVICTION_POLICY=(str, 'lru'),
+    PAGE_CACHE_WARMING=(bool, True),
+    PAGE_CACHE_EXPORT=(bool, False),
+    PAGE_CACHE_STALE_WHILE_REVALIDATE=(bool, False),
+    PAGE_CACHE_MAX_STALENESS=(int, 60 * 60),
+    PAGE_CACHE_WARM_HOST=(str, 'www.saigatours.com'),
     HCAPTCHA_SITEKEY=(str, None),
     HCAPTCHA_SECRET=(str, None),
     STRIPE_PUBLIC_KEY=(str, None),
@@ -41,6 +52,11 @@ environ.Env.read_env()
 CLOUDFLARE_API_TOKEN = env('CLOUDFLARE_API_TOKEN')
 CLOUDFLARE_ZONE_ID = env('CLOUDFLARE_ZONE_ID')
 CLOUDFLARE_DOMAIN = env('CLOUDFLARE_DOMAIN')
+CLOUDFLARE_API_BASE = env('CLOUDFLARE_API_BASE')
+# Chunks of paths purged at once, retries of each chunk, and times failed paths are requeued before giving up
+CLOUDFLARE_PURGE_CONCURRENCY = 4
+CLOUDFLARE_PURGE_RETRIES = 5
+CLOUDFLARE_PURGE_REQUEUES = 5
 NOCACHE = env('NOCACHE')
 NO_CACHE_INVALIDATION = env('NO_CACHE_INVALIDATION')
 
@@ -134,6 +150,8 @@ SITE_ID = 1
 
 
 MIDDLEWARE = [
+    # Outermost, so it collects invalidations from saves made anywhere in the request
+    'main.middleware.CollectInvalidations',
     'django.middleware.common.BrokenLinkEmailsMiddleware',
     'django.middleware.gzip.GZipMiddleware',
     'silk.middleware.SilkyMiddleware',
@@ -242,6 +260,129 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
 CACHE_ROOT = BASE_DIR / 'cached_pages'
+# Also write cached pages under CACHE_ROOT, /x/ as x/index.html and /x as x.html (plus .gz and .br), so the front end
+# can serve them before reaching Django, e.g. for requests without a session cookie or query string:
+#   try_files /cached_pages$uri/index.html /cached_pages$uri.html @django;
+PAGE_CACHE_EXPORT = env('PAGE_CACHE_EXPORT')
+
+# Anonymous pages are cached in a per-worker LRU, then the shared 'pages' store, then the PageCache table
+PAGE_CACHE_MEMORY_BYTES = env('PAGE_CACHE_MEMORY_MB') * 1024 * 1024
+PAGE_CACHE_SHARED_ALIAS = 'pages'
+# Seconds pages are kept in the shared tier before being reloaded from the PageCache table
+PAGE_CACHE_SHARED_TIMEOUT = 15 * 60
+
+# Pages with query parameters are only cached when every parameter is allowed for the path, matched with fnmatch,
+# and its value passes the check named here (see main.cache.QUERY_PARAM_VALIDATORS). Parameters are canonicalised and
+# sorted into the cache key, and left out of it when they hold their default value.
+PAGE_CACHE_QUERY_PARAMS = {
+    r'^/(news|blog)/$': {
+        'page': 'page',
+        'author': 'author',
+        'start': 'date',
+        'end': 'date',
+        'tag-*': 'tag',
+        'author-*': 'author',
+    },
+    r'^/tour/[^/]+$': {'parent': 'tour'},
+}
+PAGE_CACHE_QUERY_DEFAULTS = {
+    'page': '1',
+    'start': '',
+    'end': '',
+    'parent': '',
+}
+# Higher page numbers aren't cached
+PAGE_CACHE_MAX_PAGE = 200
+
+# Seconds between each worker writing its per-url hit, miss and invalidation counts to PageCacheStats
+PAGE_CACHE_STATS_FLUSH_INTERVAL = 60
+
+# Concurrent misses for the same page wait this many seconds for a single render instead of rendering it themselves
+PAGE_CACHE_SINGLE_FLIGHT_WAIT = 5
+PAGE_CACHE_RENDER_LOCK_TIMEOUT = 30
+
+# Mark invalidated pages stale and keep serving them (for up to PAGE_CACHE_MAX_STALENESS seconds) while they re-render
+PAGE_CACHE_STALE_WHILE_REVALIDATE = env('PAGE_CACHE_STALE_WHILE_REVALIDATE')
+PAGE_CACHE_MAX_STALENESS = env('PAGE_CACHE_MAX_STALENESS')
+
+# Invalidations from the same request or transaction are merged, then queued to run after this many seconds so that
+# invalidations from any other requests in the meantime are merged into the same task
+PAGE_CACHE_INVALIDATION_DELAY = 5
+
+# The queue periodically evicts PageCaches not hit for PAGE_CACHE_TTL seconds, then the least recently ('lru') or
+# least frequently ('lfu') used ones until the table holds at most PAGE_CACHE_MAX_BYTES
+PAGE_CACHE_MAX_BYTES = env('PAGE_CACHE_DATABASE_MB') * 1024 * 1024
+PAGE_CACHE_TTL = env('PAGE_CACHE_TTL')
+PAGE_CACHE_EVICTION_POLICY = env('PAGE_CACHE_EVICTION_POLICY')
+PAGE_CACHE_EVICTION_INTERVAL = 15 * 60
+
+# Re-render invalidated pages in the background so visitors don't pay the render cost
+PAGE_CACHE_WARMING = env('PAGE_CACHE_WARMING')
+PAGE_CACHE_WARM_HOST = env('PAGE_CACHE_WARM_HOST')
+PAGE_CACHE_WARM_WORKERS = 4
+PAGE_CACHE_WARM_LIMIT = 1000
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    PAGE_CACHE_SHARED_ALIAS: {
+        'BACKEND': 'diskcache.DjangoCache',
+        'LOCATION': str(BASE_DIR / 'page_cache_store'),
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'size_limit': env('PAGE_CACHE_SHARED_MB') * 1024 * 1024,
+        },
+    },
+}
+
+# run_queue workers claim a task for TASK_LEASE_SECONDS, renewing the lease every TASK_LEASE_RENEW_INTERVAL seconds
+# while it runs. A task whose lease runs out (its worker died) can be claimed by another worker.
+TASK_LEASE_SECONDS = 5 * 60
+TASK_LEASE_RENEW_INTERVAL = 60
+# run_queue restarts each worker after this many tasks, bounding memory growth from imports like torch (best with
+# --processes, where the restarted worker is a fresh process)
+TASK_WORKER_MAX_TASKS = 200
+# add_task wakes idle workers through Unix sockets in TASK_NOTIFY_DIR. Without a notification, idle workers check
+# the queue after TASK_POLL_INTERVAL seconds, doubling up to TASK_POLL_MAX_INTERVAL while the queue stays empty
+TASK_NOTIFY_DIR = BASE_DIR / 'task_notify'
+TASK_POLL_INTERVAL = 1
+TASK_POLL_MAX_INTERVAL = 30
+# Failed tasks are retried TASK_DEFAULT_RETRIES times, waiting TASK_RETRY_BACKOFF seconds and doubling each time up to
+# TASK_RETRY_MAX_BACKOFF, unless their job sets its own policy with job_queue.utils.task_policy
+TASK_DEFAULT_RETRIES = 3
+TASK_RETRY_BACKOFF = 30
+TASK_RETRY_MAX_BACKOFF = 60 * 60
+
+# Jobs queued by run_queue on a schedule, every 'interval' seconds or on a five field 'cron' schedule in TIME_ZONE,
+# delayed by up to 'jitter' seconds so hosts don't all hit the database at once. Optionally with 'args', 'kwargs',
+# 'queue' and 'priority' for the queued task
+PERIODIC_JOBS = {
+    'check_links': {
+        'job': 'main.models.check_links',
+        'interval': 10 * 60,
+        'jitter': 60,
+        'kwargs': {'batch_size': 50},
+        'queue': 'links',
+    },
+    'batch_close_views': {
+        'job': 'analytics.views.batch_close_views',
+        'interval': 5 * 60,
+        'jitter': 30,
+    },
+    'evict_page_cache': {
+        'job': 'main.models.evict_page_cache',
+        'interval': PAGE_CACHE_EVICTION_INTERVAL,
+        'jitter': 60,
+        'queue': 'cache',
+        'priority': -10,
+    },
+    'rollup_analytics': {
+        'job': 'analytics.views.rollup_analytics',
+        'cron': '30 3 * * *',
+        'jitter': 10 * 60,
+    },
+}
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 #EMAIL_HOST = 'smtp.gmail.com'
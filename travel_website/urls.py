@@ -22,15 +22,7 @@ from django.contrib.sitemaps.views import sitemap
 from django.views.generic import TemplateView
 from two_factor.urls import urlpatterns as tf_urls
 
-from main.sitemaps import (TourSitemap,
-                           PageSitemap,
-                           ArticleSitemap,
-                           DetailsSitemap,
-                           RegionToursMap,
-                           RegionGuidesMap,
-                           DestinationToursMap,
-                           DestinationGuidesMap,
-                           StaticPagesMap)
+from main.sitemaps import sitemaps
 
 from customers import views
 
@@ -40,17 +32,7 @@ urlpatterns = [
     path('stats/', include('analytics.urls')),
     path('sitemap.xml',
          sitemap,
-         {'sitemaps': {
-             'tours': TourSitemap,
-             'pages': PageSitemap,
-             'articles': ArticleSitemap,
-             'details': DetailsSitemap,
-             'regiontours': RegionToursMap,
-             'regionguides': RegionGuidesMap,
-             'destinationtours': DestinationToursMap,
-             'destinationguides': DestinationGuidesMap,
-             'static': StaticPagesMap
-         }},
+         {'sitemaps': sitemaps},
          name='django.contrib.sitemaps.views.sitemap'),
     path('silk/', include('silk.urls', namespace='silk')),
     path('media/form_files/<uuid:user_id>/<uuid:form_id>/<str:filename>/', views.form_file, name='form_file'),